@@ -0,0 +1,229 @@
+import numpy as np
+import pandas as pd
+
+
+r"""
+This module finds and patches anomalous days in daily series.
+
+Everything works on a (days x series) array at once, so a whole fleet of
+metrics is cleaned in one pass.  Two rules flag days:
+
+- mad: robust z-score of the day against the rolling median and rolling
+  median absolute deviation (MAD) around it.
+- pctChange: absolute percent change over the previous day, the rule
+  BaseConfig._detectAnomalies has always logged.  Only days that are also
+  that far from the rolling median count, so the day a spike ends on is not
+  flagged as a second anomaly.
+
+Series with several steps a day, hourly ones, pass stepsPerDay.  Every step
+is then scored against the same step of the days around it, so the daily
+cycle itself is not flagged, and windows and gaps stay in days.
+
+Flagged days are merged into runs and every run is replaced by a straight
+line between the good days on either side, truncated to whole numbers like
+BaseConfig.patchSeries does.
+"""
+
+anomalyRules = ['mad', 'pctChange', 'both']
+
+# Scales the MAD of normal data to its standard deviation.
+_MAD_SCALE = 1.4826
+
+
+def anomalyScores(values, window=29, minPeriods=7, stepsPerDay=1):
+    r"""
+    Robust z-scores, and percent changes over the previous day capped by the
+    percent deviation from the rolling median, all with the shape of values.
+
+    values is a (steps x series) or 1-D array with stepsPerDay steps a day.
+    The rolling median and MAD are centered windows of window days of the
+    same step of the day.
+    """
+
+    vals2d = np.asarray(values, dtype=float).reshape(len(values), -1)
+    numSteps, numSeries = vals2d.shape
+
+    # Fold to (days x steps of the day x series), padding the last day.
+    numDays = -(-numSteps // stepsPerDay)
+    folded = np.full((numDays*stepsPerDay, numSeries), np.nan)
+    folded[:numSteps] = vals2d
+    df = pd.DataFrame(folded.reshape(numDays, stepsPerDay*numSeries))
+
+    rolling = df.rolling(window, center=True, min_periods=minPeriods)
+    median = rolling.median()
+    mad = ((df - median)
+           .abs()
+           .rolling(window, center=True, min_periods=minPeriods)
+           .median())
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = ((df - median) / (_MAD_SCALE*mad)).abs().to_numpy(copy=True)
+        pct = np.minimum(df.diff().abs() / df.shift(1),
+                         (df - median).abs() / median).to_numpy(copy=True)
+
+    # Flat windows have zero MAD, nothing in them is anomalous by this rule.
+    z[~np.isfinite(z)] = 0
+    pct[~np.isfinite(pct)] = 0
+
+    def unfold(scores):
+        return (scores.reshape(numDays*stepsPerDay, numSeries)[:numSteps]
+                .reshape(np.shape(values)))
+
+    return unfold(z), unfold(pct)
+
+
+def anomalyMask(z, pct, rule='both', zThreshold=6.0, pctThreshold=0.5):
+    r""" Boolean array flagging the days rule finds anomalous. """
+
+    if rule not in anomalyRules:
+        raise ValueError('Unknown anomaly rule %s.' % rule)
+
+    mask = np.zeros(np.shape(z), dtype=bool)
+    if rule in ('mad', 'both'):
+        mask |= z > zThreshold
+    if rule in ('pctChange', 'both'):
+        mask |= pct > pctThreshold
+
+    return mask
+
+
+def anomalyRuns(mask, maxGap=0):
+    r"""
+    Runs of flagged days in a (days x series) or 1-D mask.
+
+    Runs separated by at most maxGap unflagged days are merged, and the days
+    between them are flagged too.  Returns (runs, mask), runs being a frame
+    with the series column and first and last day positions of every run.
+    """
+
+    mask = np.asarray(mask, dtype=bool)
+    mask2d = mask.reshape(len(mask), -1)
+
+    if maxGap > 0:
+        # A gap of up to maxGap days is closed if flagged on both sides.
+        numDays = mask2d.shape[0]
+        pos = np.arange(numDays)[:, None]
+        lastFlag = np.maximum.accumulate(np.where(mask2d, pos, -numDays),
+                                         axis=0)
+        nextFlag = np.minimum.accumulate(
+            np.where(mask2d, pos, 2*numDays)[::-1], axis=0)[::-1]
+        mask2d = mask2d | ((nextFlag - lastFlag <= maxGap + 1)
+                           & (lastFlag >= 0) & (nextFlag < numDays))
+
+    padded = np.zeros((mask2d.shape[0] + 2, mask2d.shape[1]), dtype=np.int8)
+    padded[1:-1] = mask2d
+    edges = np.diff(padded, axis=0)
+
+    # Column-major order, so the runs of each series come out together.
+    startCol, startDay = np.nonzero(edges.T == 1)
+    _, endDay = np.nonzero(edges.T == -1)
+
+    runs = pd.DataFrame({'series': startCol,
+                         'first': startDay,
+                         'last': endDay - 1})
+
+    return runs, mask2d.reshape(mask.shape)
+
+
+def patchMasked(values, mask):
+    r"""
+    Copy of values with every masked day linearly interpolated from the
+    nearest unmasked days on either side, truncated to whole numbers.
+
+    Masked days at either end of a series take the value of the nearest
+    unmasked day.  Series with no unmasked day are left alone.
+    """
+
+    values = np.asarray(values, dtype=float)
+    vals2d = values.reshape(len(values), -1).copy()
+    mask2d = np.asarray(mask, dtype=bool).reshape(vals2d.shape)
+
+    numDays = vals2d.shape[0]
+    pos = np.broadcast_to(np.arange(numDays)[:, None], vals2d.shape)
+    cols = np.broadcast_to(np.arange(vals2d.shape[1]), vals2d.shape)
+
+    # Positions of the previous and next good day, -1 or numDays for none.
+    prevGood = np.maximum.accumulate(np.where(mask2d, -1, pos), axis=0)
+    nextGood = np.minimum.accumulate(
+        np.where(mask2d, numDays, pos)[::-1], axis=0)[::-1]
+
+    hasPrev = prevGood >= 0
+    hasNext = nextGood < numDays
+    prevGood = np.where(hasPrev, prevGood, nextGood).clip(0, numDays - 1)
+    nextGood = np.where(hasNext, nextGood, prevGood).clip(0, numDays - 1)
+
+    prevVal = vals2d[prevGood, cols]
+    nextVal = vals2d[nextGood, cols]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(nextGood > prevGood,
+                        (pos - prevGood) / (nextGood - prevGood),
+                        0)
+
+    patch = mask2d & (hasPrev | hasNext)
+    vals2d[patch] = np.trunc(prevVal + (nextVal - prevVal)*frac)[patch]
+
+    return vals2d.reshape(values.shape)
+
+
+def auditRuns(runs, dates, columns, values, patched, z, pct, stepsPerDay=1):
+    r""" One row per run with its dates, worst scores and mean change. """
+
+    audit = []
+    for series, first, last in runs[['series', 'first', 'last']].values:
+        sl = slice(first, last + 1)
+        audit.append({
+            'metric': columns[series],
+            'firstDate': dates[first],
+            'lastDate': dates[last],
+            'numDays': (last - first + 1) / stepsPerDay,
+            'maxZScore': z[sl, series].max(),
+            'maxPctChange': pct[sl, series].max(),
+            'meanBefore': values[sl, series].mean(),
+            'meanAfter': patched[sl, series].mean()
+        })
+
+    return pd.DataFrame(audit, columns=['metric', 'firstDate', 'lastDate',
+                                        'numDays', 'maxZScore', 'maxPctChange',
+                                        'meanBefore', 'meanAfter'])
+
+
+def cleanPanel(panelDf,
+               rule='both',
+               zThreshold=6.0,
+               pctThreshold=0.5,
+               window=29,
+               maxGap=0,
+               stepsPerDay=1):
+    r"""
+    Find and patch the anomalous runs of every column of a frame with
+    stepsPerDay rows a day.  window and maxGap are in days.
+
+    Returns (patchedDf, audit), audit having one row per patched run.
+    """
+
+    values = panelDf.values.astype(float)
+
+    z, pct = anomalyScores(values, window=window, stepsPerDay=stepsPerDay)
+    mask = anomalyMask(z,
+                       pct,
+                       rule=rule,
+                       zThreshold=zThreshold,
+                       pctThreshold=pctThreshold)
+    runs, mask = anomalyRuns(mask, maxGap=maxGap*stepsPerDay)
+    patched = patchMasked(values, mask)
+
+    audit = auditRuns(runs,
+                      panelDf.index,
+                      panelDf.columns,
+                      values,
+                      patched,
+                      z,
+                      pct,
+                      stepsPerDay=stepsPerDay)
+
+    patchedDf = pd.DataFrame(patched,
+                             index=panelDf.index,
+                             columns=panelDf.columns)
+
+    return patchedDf, audit
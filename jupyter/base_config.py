@@ -1,12 +1,23 @@
 import pandas as pd
 import numpy as np
 from dateutil.relativedelta import relativedelta
-from IPython import embed
+
+from ingest import loadSeries, resolutions
+from anomalies import cleanPanel
+from instrumentation import getLogger, span
+
+logger = getLogger(__name__)
 
 
 class BaseConfig:
     r"""
     Class for holding data pipeline and config for any forecasting model I use.
+
+    The series is kept compact, as its first date (datasetStart) and one
+    contiguous array of values (datasetValues), row i being datasetStart plus
+    i steps.  A step is a day, or an hour with resolution='hourly'.
+    self.dataset builds a Date indexed frame from them on access, and
+    self.datasetSeries a Series sharing their memory.
     """
 
     def __init__(self,
@@ -17,7 +28,15 @@ class BaseConfig:
                  minDateData=None,  # infer
                  maxDateData=None,  # infer
                  numDaysPred=730,
-                 detectAnomalies=False):
+                 detectAnomalies=False,
+                 cachePath=None,
+                 chunkSize=None,
+                 dailyData=None,
+                 dtype='float64',
+                 resolution='daily'):
+        if resolution not in resolutions:
+            raise ValueError('Unknown resolution %s.' % resolution)
+
         self.runId = runId
         self.dataPath = dataPath
         self.outPath = outPath
@@ -25,20 +44,29 @@ class BaseConfig:
         self.minDateData = minDateData
         self.maxDateData = maxDateData
         self.numDaysPred = numDaysPred
+        self.cachePath = cachePath
+        self.chunkSize = chunkSize
+        # One of ingest.resolutions.  numDaysPred stays in days either way.
+        self.resolution = resolution
+        # float32 halves the memory of every resident series.
+        self.datasetDtype = np.dtype(dtype)
 
         #######################
         # Load and prep dataset
         #######################
-        df = pd.read_csv('%s/%s.csv' % (dataPath, metric),
-                         parse_dates=True)  # This doesn't work...???
-        df['Date'] = pd.to_datetime(df['Date'])
-
-        dataset = (df
-                   .drop('Time', axis=1)
-                   .groupby('Date')  # V1 - only look at daily averages.
-                   .mean()
-                   .dropna())  # ???
-        dataset.columns = [metric]
+        # Daily (or hourly) averages, read from the ingest cache if cachePath
+        # is set and streamed in chunks if chunkSize is set.  dailyData is an
+        # already loaded (df, meanVal) pair at this resolution, as returned
+        # by loadSeries.
+        if dailyData is not None:
+            dataset, meanVal = dailyData
+        else:
+            with span('ingest'):
+                dataset, meanVal = loadSeries(dataPath,
+                                              metric,
+                                              resolution,
+                                              cachePath=cachePath,
+                                              chunkSize=chunkSize)
 
         # Limit data for testing or to remove weird behavior
         if minDateData is not None:
@@ -54,11 +82,12 @@ class BaseConfig:
 
         # Fill in missing rows and impute nulls with 1 (why 1?)
         # TODO: Use the lead(1) logic from Fourier components here.
-        meanVal = df[metric].dropna().mean()
-        self.dataset = self._imputeDates(dataset,
-                                         self.firstObservedDate,
-                                         self.lastObservedDate,
-                                         imputeVal=meanVal)
+        self.imputeVal = meanVal
+        self.datasetStart = self.firstObservedDate
+        self.datasetValues = self._imputeDates(dataset,
+                                               self.firstObservedDate,
+                                               self.lastObservedDate,
+                                               imputeVal=meanVal)
 
         self.maxForecastEndDate = (self.lastObservedDate
                                    + relativedelta(self.lastObservedDate,
@@ -67,54 +96,208 @@ class BaseConfig:
         if detectAnomalies:
             _ = self._detectAnomalies()
 
+    @classmethod
+    def fromSeries(cls, series, metric=None, imputeVal=None, **kwargs):
+        r"""
+        Build from a daily (or, with resolution='hourly' in kwargs, hourly)
+        Series with a Date index instead of a csv.
+
+        metric defaults to the series name and imputeVal, used for missing
+        rows, to the series mean.  kwargs go to the constructor.
+        """
+
+        if metric is None:
+            metric = series.name
+
+        if imputeVal is None:
+            imputeVal = series.mean()
+
+        series = pd.Series(series.values,
+                           index=pd.DatetimeIndex(series.index, name='Date'),
+                           copy=False)
+
+        return cls(metric=metric,
+                   dailyData=(series.to_frame(metric), imputeVal),
+                   **kwargs)
+
+    @classmethod
+    def fromArray(cls, values, startDate, metric, imputeVal=None, **kwargs):
+        r"""
+        Build from an array of values one step apart, the first one on
+        startDate.
+
+        NaNs count as missing rows.  See fromSeries for the rest.
+        """
+
+        idx = pd.date_range(startDate,
+                            periods=len(values),
+                            freq=resolutions[kwargs.get('resolution',
+                                                        'daily')])
+
+        return cls.fromSeries(pd.Series(values, index=idx, copy=False),
+                              metric=metric,
+                              imputeVal=imputeVal,
+                              **kwargs)
+
+    @property
+    def dataset(self):
+        r"""
+        The series as a frame with a Date index and metric column.  The
+        values are a copy, internal callers read datasetSeries instead.
+        """
+
+        return pd.DataFrame({self.metric: self.datasetValues},
+                            index=self._datasetIndex())
+
+    @property
+    def datasetSeries(self):
+        r"""
+        The series as a Series named metric, without copying datasetValues.
+        Read it, don't hold on to it across changes to the values.
+        """
+
+        return pd.Series(self.datasetValues,
+                         index=self._datasetIndex(),
+                         name=self.metric,
+                         copy=False)
+
+    def _datasetIndex(self):
+        r""" Date index of datasetValues, rebuilt only when it changes. """
+
+        key = (self.datasetStart, len(self.datasetValues), self.resolution)
+
+        # Loaded and copied models may not have the attribute yet.
+        cached = getattr(self, '_datasetIndexCache', None)
+        if cached is None or cached[0] != key:
+            idx = self._getDateIndex(self.datasetStart,
+                                     self._dateAt(len(self.datasetValues) - 1))
+            cached = self._datasetIndexCache = (key, idx)
+
+        return cached[1]
+
+    @dataset.setter
+    def dataset(self, df):
+        r""" Store a frame with a gapless Date index compactly. """
+
+        if len(df) > 0:
+            numSteps = (df.index.max() - df.index.min()) // self.step + 1
+            if numSteps != len(df) or not df.index.is_monotonic_increasing:
+                raise RuntimeError('dataset needs gapless %s rows, in order.'
+                                   % self.resolution)
+
+        self.datasetStart = df.index.min()
+        self.datasetValues = np.ascontiguousarray(df[self.metric].values,
+                                                  dtype=self.datasetDtype)
+
+    @property
+    def step(self):
+        r""" Time between rows, as a Timedelta. """
+
+        return pd.Timedelta(1, unit=resolutions[self.resolution])
+
+    @property
+    def stepsPerDay(self):
+        return pd.Timedelta(days=1) // self.step
+
+    @property
+    def numStepsPred(self):
+        r""" Number of rows forecast, numDaysPred days of them. """
+
+        return self.numDaysPred * self.stepsPerDay
+
+    def _stepOffset(self, date):
+        r""" Position of date in datasetValues. """
+
+        return (pd.to_datetime(date) - self.datasetStart) // self.step
+
+    def _dateAt(self, offset):
+        r""" Date of position offset in datasetValues. """
+
+        return self.datasetStart + offset * self.step
+
     def _detectAnomalies(self, threshold=0.5):
         r"""
         Detect days that deviate more than threshold.
 
-        Deviation is measured in percent absolute change day over day.
+        Deviation is measured in percent absolute change day over day, for
+        hourly series against the same hour of the day before.
         """
 
-        today = self.dataset[self.metric]
-        prevDay = today.shift(1)
+        today = self.datasetSeries
+        prevDay = today.shift(self.stepsPerDay)
 
         se = ((np.abs(today - prevDay) / prevDay)
               .dropna()
               .sort_values(ascending=False))
 
-        anomalousDays = pd.Series(se[se > 0.5],
+        anomalousDays = pd.Series(se[se > threshold],
                                   name='Percent diff over previous day')
 
-        print('Found the following anomalous days:')
-        print(anomalousDays)
+        logger.info('Found the following anomalous days:\n%s' % anomalousDays)
 
         return anomalousDays
 
+    def patchAnomalies(self,
+                       rule='both',
+                       zThreshold=6.0,
+                       pctThreshold=0.5,
+                       window=29,
+                       maxGap=0,
+                       dryRun=False):
+        r"""
+        Find every anomalous run of steps and patch them all at once.
+
+        rule is one of anomalies.anomalyRules: 'mad' flags steps more than
+        zThreshold robust z-scores from the rolling median of the same step
+        of the day over a window day window, 'pctChange' flags steps more
+        than pctThreshold from the same step the day before, 'both' flags
+        either.  Runs at most maxGap days apart are merged.  With dryRun
+        nothing is patched.
+
+        Returns the audit table, one row per run.
+        """
+
+        patchedDf, audit = cleanPanel(self.datasetSeries.to_frame(),
+                                      rule=rule,
+                                      zThreshold=zThreshold,
+                                      pctThreshold=pctThreshold,
+                                      window=window,
+                                      maxGap=maxGap,
+                                      stepsPerDay=self.stepsPerDay)
+
+        logger.info('Found %d anomalous runs covering %g days.'
+                    % (len(audit), audit['numDays'].sum()))
+
+        if not dryRun:
+            self.datasetValues = patchedDf[self.metric].values.astype(
+                self.datasetDtype)
+
+        return audit
+
     def _bumpZeros(self, valToBump=1):
         r"""
         Replace any zeros with valToBump.  Useful for Box-Cox transformation.
         """
 
-        zeroInds = (self.dataset[self.metric] <= 0)
-        self.dataset.loc[zeroInds, self.metric] = valToBump
+        self.datasetValues[self.datasetValues <= 0] = valToBump
 
     def patchSeries(self, firstDatePatch, lastDatePatch):
         r""" Patch anomalous values of series with linear interpolation.  """
 
-        # Get x and y values on either side of the anomalous data for
-        # interpolation
-        lastDayObs = pd.to_datetime(firstDatePatch) + relativedelta(days=-1)
-        nextDayObs = pd.to_datetime(lastDatePatch) + relativedelta(days=1)
+        first = self._stepOffset(firstDatePatch)
+        last = self._stepOffset(lastDatePatch)
 
-        lastDateVal = self.dataset.loc[lastDayObs, self.metric]
-        nextDateVal = self.dataset.loc[nextDayObs, self.metric]
+        if first < 1 or last > len(self.datasetValues) - 2:
+            raise RuntimeError('Need an observed row on both sides of patch.')
 
-        interpDf = self._interpolate(firstDatePatch,
-                                     lastDatePatch,
-                                     lastDateVal,
-                                     nextDateVal)
+        # Get y values on either side of the anomalous data for interpolation
+        lastDateVal = self.datasetValues[first - 1]
+        nextDateVal = self.datasetValues[last + 1]
 
-        # Patch in values and recalculate rolling average
-        self.dataset.loc[firstDatePatch:lastDatePatch, self.metric] = interpDf
+        self.datasetValues[first:last + 1] = self._interpolate(firstDatePatch,
+                                                               lastDatePatch,
+                                                               lastDateVal,
+                                                               nextDateVal)
 
     def _interpolate(self,
                      firstDayMissing,
@@ -125,38 +308,44 @@ class BaseConfig:
         Linearly interpolate the missing values between dates.
 
         Assumes the rows already exist, but are null or should be overwritten
-        for some reason.
+        for some reason.  Returns the values, truncated to whole numbers.
         """
 
-        numDaysImpute = (pd.to_datetime(lastDayMissing)
-                         - pd.to_datetime(firstDayMissing)).days + 1
+        numRowsImpute = (pd.to_datetime(lastDayMissing)
+                         - pd.to_datetime(firstDayMissing)) // self.step + 1
 
         # Rise over run.  In this case, run is the gap between observations,
         # so one plus the number of rows imputing.
-        slope = (nextDateVal - lastDateVal) / (numDaysImpute + 1)
-
-        imputedVals = pd.Series(
-            np.linspace(
-                lastDateVal+slope,
-                nextDateVal-slope,
-                numDaysImpute
-            ),
-            index=self._getDateIndex(
-                pd.to_datetime(firstDayMissing),
-                pd.to_datetime(lastDayMissing)
-            )
-        ).astype(int)
+        slope = (nextDateVal - lastDateVal) / (numRowsImpute + 1)
+
+        imputedVals = np.trunc(np.linspace(lastDateVal+slope,
+                                           nextDateVal-slope,
+                                           numRowsImpute))
 
         return imputedVals
 
     def _imputeDates(self, tsDf, minDate, maxDate, imputeVal=np.nan):
         r"""
         Impute missing dates into a time series and impute with imputeVal.
+
+        Returns the values of every step from minDate to maxDate as an array.
+        Rows of tsDf outside that range are dropped.
         """
-        imputeDf = pd.DataFrame(index=self._getDateIndex(minDate, maxDate))
+        minDate = pd.to_datetime(minDate)
+        numSteps = (pd.to_datetime(maxDate) - minDate) // self.step + 1
+
+        vals = np.full(numSteps, imputeVal, dtype=self.datasetDtype)
+
+        offsets = np.asarray((tsDf.index - minDate) // self.step)
+        observed = tsDf[self.metric].values
+        keep = (offsets >= 0) & (offsets < numSteps) & ~np.isnan(observed)
+        vals[offsets[keep]] = observed[keep]
 
-        return tsDf.join(imputeDf, how='outer').fillna(imputeVal)
+        return vals
 
     def _getDateIndex(self, minDate, maxDate):
-        r""" Make pandas date index of range. """
-        return pd.Index(pd.date_range(minDate, maxDate), name='Date')
+        r""" Make pandas date index of range, one row per step. """
+        return pd.Index(pd.date_range(minDate,
+                                      maxDate,
+                                      freq=resolutions[self.resolution]),
+                        name='Date')
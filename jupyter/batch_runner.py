@@ -0,0 +1,250 @@
+import os
+import time
+import traceback
+from glob import glob
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing as mp
+
+from dateutil.relativedelta import relativedelta
+
+from instrumentation import getLogger, recording
+from shared_store import SharedDatasetStore
+
+logger = getLogger(__name__)
+
+
+r"""
+This module runs the forecast pipeline for many metrics at once.
+
+Each metric is fit, predicted and validated in its own worker process, so a
+metric that raises (e.g. a negative Box-Cox lambda) is recorded as a failure
+without taking down the rest of the run.
+"""
+
+
+def listMetrics(dataPath='./data'):
+    r""" Names of all metrics with a <metric>.csv file under dataPath. """
+
+    paths = glob(os.path.join(dataPath, '*.csv'))
+
+    return sorted(os.path.splitext(os.path.basename(p))[0] for p in paths)
+
+
+def runBatch(metrics=None,
+             dataPath='./data',
+             outPath='./out',
+             runId='TEST',
+             numWorkers=None,
+             validationMonths=1,
+             generateDeliverables=False,
+             renderPreset='batch',
+             modelKwargs=None,
+             metricKwargs=None,
+             sharedMemory=False,
+             summaries=False):
+    r"""
+    Fit, predict and validate every metric on a process pool.
+
+    metrics defaults to every <metric>.csv under dataPath.  modelKwargs are
+    passed to every DecomposedArima, metricKwargs maps metric name to extra
+    per-metric kwargs (e.g. minDateData) which override modelKwargs.  Setting
+    'boxCoxLambda' in either sets the Box-Cox parameter manually.  With
+    generateDeliverables, every worker also saves its plots and csvs under
+    outPath, rendered with the renderPreset plot settings.
+
+    Returns (results, failures), both dicts keyed by metric.  Each result
+    holds predDf, valDf, the summaries, the elapsed seconds and the pipeline
+    spans (see instrumentation.aggregateSpans); each failure holds the
+    formatted traceback.  The ARIMA and global trend summaries are only built
+    with summaries or generateDeliverables set, and are None otherwise.
+
+    With sharedMemory, the parent loads every metric once into a
+    SharedDatasetStore and workers build their models from it, instead of
+    each reading its own csv.  It only holds daily series.
+    """
+
+    if sharedMemory and (modelKwargs or {}).get('resolution',
+                                                'daily') != 'daily':
+        raise ValueError('sharedMemory only holds daily series.')
+
+    if metrics is None:
+        metrics = listMetrics(dataPath)
+
+    if numWorkers is None:
+        numWorkers = os.cpu_count() or 1
+
+    jobs = []
+    for metric in metrics:
+        kwargs = dict(modelKwargs or {})
+        kwargs.update((metricKwargs or {}).get(metric, {}))
+        kwargs.update(dataPath=dataPath,
+                      outPath=outPath,
+                      runId=runId,
+                      metric=metric)
+        jobs.append((kwargs,
+                     validationMonths,
+                     generateDeliverables,
+                     renderPreset,
+                     summaries))
+
+    results = {}
+    failures = {}
+
+    logger.info('Forecasting %d metrics on %d workers.'
+                % (len(jobs), numWorkers))
+
+    store = None
+    if sharedMemory:
+        store = SharedDatasetStore.create(dataPath,
+                                          metrics,
+                                          cachePath=(modelKwargs or {}).get(
+                                              'cachePath'),
+                                          chunkSize=(modelKwargs or {}).get(
+                                              'chunkSize'))
+
+    # Spawn rather than fork, so each worker starts fresh, without a copy of
+    # the parent's pyplot state or BLAS thread pools.
+    ctx = mp.get_context('spawn')
+
+    try:
+        # Workers are spawned on demand for the whole run, and take the
+        # environment at that moment.
+        with singleThreadedBlas():
+            pool = ProcessPoolExecutor(
+                max_workers=numWorkers,
+                mp_context=ctx,
+                initializer=_initWorker,
+                initargs=(None if store is None else store.handle(),))
+
+            try:
+                _collectResults(pool, jobs, results, failures)
+            finally:
+                pool.shutdown()
+    finally:
+        if store is not None:
+            store.unlink()
+
+    logger.info('Finished: %d succeeded, %d failed.'
+                % (len(results), len(failures)))
+
+    return results, failures
+
+
+def _collectResults(pool, jobs, results, failures):
+    r""" Run jobs on pool, filling results and failures by metric. """
+
+    with pool:
+        futures = {pool.submit(_forecastMetric, *job): job[0]['metric']
+                   for job in jobs}
+
+        for future in as_completed(futures):
+            metric = futures[future]
+
+            try:
+                status, payload = future.result()
+            except Exception:
+                # The worker itself died, e.g. it was killed for memory.
+                status, payload = 'failed', traceback.format_exc()
+
+            if status == 'ok':
+                results[metric] = payload
+            else:
+                failures[metric] = payload
+                logger.warning('Metric %s failed.' % metric)
+
+
+@contextmanager
+def singleThreadedBlas():
+    r"""
+    Set the BLAS thread variables to one, unless already set, and restore
+    them on exit.
+
+    Processes spawned inside inherit them.  Setting them in the workers is
+    too late, as unpickling their first job already imports numpy.  Without
+    the limit the workers fight over cores and wall time stops scaling with
+    numWorkers.
+    """
+
+    added = [var for var in ['OMP_NUM_THREADS',
+                             'OPENBLAS_NUM_THREADS',
+                             'MKL_NUM_THREADS']
+             if var not in os.environ]
+
+    for var in added:
+        os.environ[var] = '1'
+
+    try:
+        yield
+    finally:
+        for var in added:
+            os.environ.pop(var, None)
+
+
+# The SharedDatasetStore of this worker process, if runBatch made one.
+_workerStore = None
+
+
+def _initWorker(storeHandle=None):
+    r""" Attach to the shared dataset store if there is one. """
+
+    global _workerStore
+
+    if storeHandle is not None:
+        _workerStore = SharedDatasetStore.attach(storeHandle)
+
+
+def _forecastMetric(kwargs,
+                    validationMonths,
+                    generateDeliverables,
+                    renderPreset,
+                    summaries=False):
+    r"""
+    Worker entry point.  Never raises; returns ('ok', result) or
+    ('failed', traceback string).
+    """
+
+    # Imported here, so runBatch's module stays light to import.
+    from decomp_arima import DecomposedArima
+    from handler import generateDeliverable
+
+    start = time.perf_counter()
+
+    try:
+        kwargs = dict(kwargs)
+        boxCoxLambda = kwargs.pop('boxCoxLambda', None)
+
+        if _workerStore is not None and kwargs['metric'] in _workerStore:
+            kwargs['dailyData'] = _workerStore.dailyData(kwargs['metric'])
+
+        with recording(runId=kwargs['runId'], metric=kwargs['metric']) as rec:
+            modelOb = DecomposedArima(**kwargs)
+
+            if boxCoxLambda is not None:
+                modelOb.setBoxCoxParam(boxCoxLambda)
+
+            if generateDeliverables:
+                predDf, valDf = generateDeliverable(modelOb,
+                                                    preset=renderPreset)
+            else:
+                predDf = modelOb.predict()
+                maxDate = (modelOb.lastObservedDate
+                           + relativedelta(months=-validationMonths))
+                valDf = modelOb.validate(maxDate)
+
+        # Reading a summary builds it, and the deliverables already did.
+        withSummaries = summaries or generateDeliverables
+
+        return 'ok', {
+            'predDf': predDf,
+            'valDf': valDf,
+            'arimaSummary': (modelOb.arimaSummary if withSummaries
+                             else None),
+            'globalTrendSummary': (modelOb.globalTrendSummary
+                                   if withSummaries else None),
+            'elapsed': time.perf_counter() - start,
+            'spans': rec.toFrame()
+        }
+
+    except Exception:
+        return 'failed', traceback.format_exc()
@@ -0,0 +1,460 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import warnings
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+from synthetic_data import writeSyntheticMetric, writeSyntheticFleet
+from global_trend import fitGlobalTrends
+
+
+r"""
+Benchmarks for the forecasting pipeline on synthetic data.
+
+Run from this directory:
+
+    python benchmarks.py --suite quick --out results.json
+    python benchmarks.py --suite quick --baseline results.json
+
+With --baseline, every case slower than the baseline by more than --tolerance
+is reported and the exit code is 1.
+"""
+
+# History lengths in years, and fleet sizes in metrics.  The fleet cases only
+# time ingest and trend learning, which is what scales with metric count.
+# The service cases send serviceRequests forecast requests to service.py.
+# The resolution cases fit resolutionYears of history daily and hourly.
+# Every suite also times a cold import of the modules workers start with.
+suites = {
+    'quick': {'years': [1, 3], 'numMetrics': [1, 10], 'serviceRequests': 200,
+              'resolutionYears': [3]},
+    'full': {'years': [1, 5, 10, 20], 'numMetrics': [1, 10, 100, 1000],
+             'serviceRequests': 2000, 'resolutionYears': [3, 10]}
+}
+
+
+def runSuite(suite='quick', samplesPerDay=24, repeats=1, workDir=None):
+    r"""
+    Time every pipeline stage for each size in the suite.
+
+    Returns a dict mapping case name to the best of repeats wall seconds.
+    """
+
+    ownWorkDir = workDir is None
+    if ownWorkDir:
+        workDir = tempfile.mkdtemp(prefix='forecast_bench_')
+
+    results = benchImports(repeats=repeats)
+
+    try:
+        for years in suites[suite]['years']:
+            results.update(benchPipeline(workDir,
+                                         years=years,
+                                         samplesPerDay=samplesPerDay,
+                                         repeats=repeats))
+
+        for numMetrics in suites[suite]['numMetrics']:
+            results.update(benchFleet(workDir,
+                                      numMetrics=numMetrics,
+                                      samplesPerDay=samplesPerDay,
+                                      repeats=repeats))
+
+        for years in suites[suite]['resolutionYears']:
+            results.update(benchResolutions(workDir,
+                                            years=years,
+                                            samplesPerDay=samplesPerDay,
+                                            repeats=repeats))
+
+        results.update(benchService(workDir,
+                                    numRequests=suites[suite]['serviceRequests'],
+                                    samplesPerDay=samplesPerDay))
+    finally:
+        if ownWorkDir:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    return results
+
+
+def benchPipeline(workDir, years, samplesPerDay=24, repeats=1):
+    r""" Time each stage of one metric with years of history. """
+
+    from decomp_arima import DecomposedArima, arimaEngines
+    from handler import summarizeValidation, renderDeliverable
+
+    dataPath = os.path.join(workDir, 'pipeline_%dy' % years)
+    outPath = os.path.join(workDir, 'out')
+    os.makedirs(outPath, exist_ok=True)
+
+    metric = 'Bench%dy' % years
+    writeSyntheticMetric(dataPath,
+                         metric,
+                         years=years,
+                         samplesPerDay=samplesPerDay,
+                         yearlyAmplitude=0.2,
+                         gapFraction=0.01)
+
+    def makeModel():
+        return DecomposedArima(dataPath=dataPath,
+                               outPath=outPath,
+                               metric=metric)
+
+    prefix = 'pipeline/%dy/' % years
+    timings = {}
+
+    timings['ingest'] = _bestOf(makeModel, repeats)
+
+    modelOb = makeModel()
+    timings['learnTrendParams'] = _bestOf(lambda: _learnTrend(modelOb),
+                                          repeats)
+
+    # Reuse the full data lambda from here on, so validation cannot trip
+    # over a negative lambda on the shorter history.
+    modelOb.setBoxCoxParam(modelOb.boxCoxLambda)
+
+    tsData = modelOb.dataset[modelOb.metric]
+    timings['transformRoundTrip'] = _bestOf(
+        lambda: modelOb.backFromArimaSpace(modelOb.toArimaSpace(tsData)),
+        repeats)
+
+    # The ARIMA step alone, per engine, on the same ARIMA space data.  Short
+    # histories leave gaps only pmdarima can fit over.
+    trainEndog = modelOb.toArimaSpace(tsData)
+    for engine in arimaEngines:
+        if engine == 'numpy' and trainEndog.isna().any():
+            continue
+        modelOb.arimaEngine = engine
+        timings['arimaFit/' + engine] = _bestOf(
+            lambda: modelOb.getFreshARIMA().fit(trainEndog), repeats)
+    modelOb.arimaEngine = 'pmdarima'
+
+    timings['fit'] = _bestOf(modelOb.fit, repeats)
+    timings['predict'] = _bestOf(modelOb.predict, repeats)
+
+    maxDate = modelOb.lastObservedDate + relativedelta(months=-1)
+    timings['validate'] = _bestOf(lambda: modelOb.validate(maxDate), repeats)
+
+    predDf = modelOb.predict()
+    valDf = modelOb.validate(maxDate)
+    timings['render'] = _bestOf(
+        lambda: renderDeliverable(predDf,
+                                  valDf,
+                                  metric,
+                                  os.path.join(outPath, metric),
+                                  preset='batch',
+                                  summary=summarizeValidation(valDf)),
+        repeats)
+
+    return {prefix + k: v for k, v in timings.items()}
+
+
+def benchFleet(workDir, numMetrics, samplesPerDay=24, repeats=1):
+    r""" Time ingest and trend learning across numMetrics metrics. """
+
+    from decomp_arima import DecomposedArima
+
+    dataPath = os.path.join(workDir, 'fleet_%d' % numMetrics)
+    metrics = writeSyntheticFleet(dataPath,
+                                  numMetrics,
+                                  years=3,
+                                  samplesPerDay=samplesPerDay)
+
+    def ingestAll():
+        return [DecomposedArima(dataPath=dataPath, metric=m) for m in metrics]
+
+    models = ingestAll()
+
+    def learnAll():
+        for modelOb in models:
+            _learnTrend(modelOb)
+
+    # Every metric against every exponent candidate in one fit.
+    panel = np.column_stack([m.getRollingAvg(m.dataset[m.metric]).values
+                             for m in models])
+    exponents = np.linspace(0.5, 2, 16)
+
+    prefix = 'fleet/%d/' % numMetrics
+
+    return {
+        prefix + 'ingest': _bestOf(ingestAll, repeats),
+        prefix + 'learnTrendParams': _bestOf(learnAll, repeats),
+        prefix + 'globalTrendGrid': _bestOf(
+            lambda: fitGlobalTrends(panel, exponents), repeats)
+    }
+
+
+def benchResolutions(workDir, years, samplesPerDay=24, repeats=1):
+    r"""
+    Time learning the trend and fitting one metric at daily and at hourly
+    resolution, with every ARIMA engine.
+    """
+
+    from decomp_arima import DecomposedArima, arimaEngines
+
+    dataPath = os.path.join(workDir, 'resolution_%dy' % years)
+
+    metric = 'Resolution%dy' % years
+    writeSyntheticMetric(dataPath,
+                         metric,
+                         years=years,
+                         samplesPerDay=samplesPerDay,
+                         yearlyAmplitude=0.2,
+                         intradayAmplitude=0.3,
+                         gapFraction=0.01)
+
+    timings = {}
+    for resolution in ['daily', 'hourly']:
+        modelOb = DecomposedArima(dataPath=dataPath,
+                                  metric=metric,
+                                  resolution=resolution)
+        timings[resolution + '/learnTrendParams'] = _bestOf(
+            lambda: _learnTrend(modelOb), repeats)
+
+        trainEndog = modelOb.toArimaSpace(modelOb.dataset[modelOb.metric])
+        for engine in arimaEngines:
+            if engine == 'numpy' and trainEndog.isna().any():
+                continue
+            modelOb.arimaEngine = engine
+            timings['%s/fit/%s' % (resolution, engine)] = _bestOf(
+                modelOb.fit, repeats)
+
+    return {'resolution/%dy/' % years + k: v for k, v in timings.items()}
+
+
+def benchService(workDir,
+                 numMetrics=4,
+                 numRequests=200,
+                 concurrency=8,
+                 horizonDays=30,
+                 samplesPerDay=24):
+    r"""
+    Latency and throughput of the forecast service on synthetic models.
+
+    Every metric is refit once through the service, then numRequests
+    forecast requests spread over the metrics are sent concurrency at a
+    time.  Throughput is reported as seconds per request.
+    """
+
+    from service import ForecastService
+
+    dataPath = os.path.join(workDir, 'service_data')
+    modelPath = os.path.join(workDir, 'service_models')
+    metrics = writeSyntheticFleet(dataPath,
+                                  numMetrics,
+                                  years=3,
+                                  samplesPerDay=samplesPerDay)
+
+    async def run():
+        service = ForecastService(modelPath=modelPath,
+                                  dataPath=dataPath,
+                                  port=0,
+                                  maxModels=numMetrics,
+                                  numWorkers=numMetrics)
+        await service.start()
+
+        try:
+            start = time.perf_counter()
+            await asyncio.gather(*[
+                _request(service.port, 'POST', '/refit?metric=%s' % m)
+                for m in metrics
+            ])
+            refitSeconds = time.perf_counter() - start
+
+            # Load every model before timing the steady state.
+            await asyncio.gather(*[
+                _request(service.port,
+                         'GET',
+                         '/forecast?metric=%s&horizon=1' % m)
+                for m in metrics
+            ])
+
+            latencies = []
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def timedRequest(i):
+                target = ('/forecast?metric=%s&horizon=%d'
+                          % (metrics[i % numMetrics], horizonDays))
+                async with semaphore:
+                    requestStart = time.perf_counter()
+                    await _request(service.port, 'GET', target)
+                    latencies.append(time.perf_counter() - requestStart)
+
+            start = time.perf_counter()
+            await asyncio.gather(*[timedRequest(i)
+                                   for i in range(numRequests)])
+            totalSeconds = time.perf_counter() - start
+        finally:
+            await service.stop()
+
+        return refitSeconds, latencies, totalSeconds
+
+    refitSeconds, latencies, totalSeconds = asyncio.run(run())
+
+    prefix = 'service/%d/' % numMetrics
+
+    return {
+        prefix + 'refitAll': refitSeconds,
+        prefix + 'forecastLatencyP50': float(np.percentile(latencies, 50)),
+        prefix + 'forecastLatencyP95': float(np.percentile(latencies, 95)),
+        prefix + 'secondsPerRequest': totalSeconds / numRequests
+    }
+
+
+# Modules a worker or CLI invocation starts by importing.
+importModules = ['base_config', 'decomp_arima', 'handler', 'batch_runner',
+                 'service']
+
+# What importing decomp_arima and handler used to pull in eagerly.
+eagerDependencies = ['pmdarima', 'statsmodels.api', 'scipy.stats',
+                     'matplotlib.pyplot', 'IPython']
+
+
+def benchImports(repeats=1):
+    r"""
+    Wall seconds of a fresh interpreter importing each of importModules.
+
+    This is what every spawned worker pays before doing any work.  The
+    eagerDependencies case imports the heavy dependencies our modules load
+    on first use, for comparison.
+    """
+
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    def coldImport(statements):
+        return lambda: subprocess.run([sys.executable, '-c', statements],
+                                      cwd=here,
+                                      check=True)
+
+    results = {}
+    for module in importModules:
+        results['import/%s' % module] = _bestOf(
+            coldImport('import %s' % module), repeats)
+
+    # Skip whatever isn't installed, IPython in particular.
+    eager = ''.join('try:\n    import %s\nexcept ImportError:\n    pass\n'
+                    % module for module in eagerDependencies)
+    results['import/eagerDependencies'] = _bestOf(coldImport(eager), repeats)
+
+    return results
+
+
+async def _request(port, method, target, host='127.0.0.1'):
+    r""" Send one HTTP request and return (status, decoded json body). """
+
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(('%s %s HTTP/1.1\r\nHost: %s\r\n\r\n'
+                  % (method, target, host)).encode())
+    await writer.drain()
+
+    response = await reader.read()
+    writer.close()
+
+    head, _, body = response.partition(b'\r\n\r\n')
+    status = int(head.split()[1])
+    if status != 200:
+        raise RuntimeError('%s %s returned %d: %s'
+                           % (method, target, status, body.decode()))
+
+    return status, json.loads(body)
+
+
+def compareToBaseline(results, baseline, tolerance=0.25):
+    r"""
+    Compare results to baseline timings.
+
+    Returns a frame with the ratio of each case to its baseline, flagging
+    cases more than tolerance slower as regressions.
+    """
+
+    df = pd.DataFrame({'seconds': pd.Series(results),
+                       'baselineSeconds': pd.Series(baseline)})
+    df['ratio'] = df['seconds'] / df['baselineSeconds']
+    df['regression'] = df['ratio'] > 1 + tolerance
+
+    return df
+
+
+def saveResults(results, path):
+    r""" Save timings with enough context to judge a later comparison. """
+
+    with open(path, 'w') as fh:
+        json.dump({'python': platform.python_version(),
+                   'machine': platform.machine(),
+                   'cpuCount': os.cpu_count(),
+                   'results': results},
+                  fh,
+                  indent=2)
+
+
+def loadResults(path):
+    with open(path) as fh:
+        return json.load(fh)['results']
+
+
+def _learnTrend(modelOb):
+    r"""
+    Learn trend parameters, falling back to a manual Box-Cox lambda when the
+    MLE goes negative, as an analyst would.
+    """
+
+    try:
+        modelOb.learnTrendParams()
+    except RuntimeError:
+        modelOb.setBoxCoxParam(0.5)
+        modelOb.learnTrendParams()
+
+
+def _bestOf(func, repeats):
+    r""" Minimum wall seconds of func over repeats calls. """
+
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--suite', default='quick', choices=sorted(suites))
+    parser.add_argument('--samples-per-day', type=int, default=24)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--out', help='save results as json here')
+    parser.add_argument('--baseline', help='compare to results json')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+
+    results = runSuite(args.suite,
+                       samplesPerDay=args.samples_per_day,
+                       repeats=args.repeats)
+
+    if args.out is not None:
+        saveResults(results, args.out)
+
+    if args.baseline is None:
+        print(pd.Series(results, name='seconds').to_string())
+        return 0
+
+    compDf = compareToBaseline(results,
+                               loadResults(args.baseline),
+                               tolerance=args.tolerance)
+    print(compDf.to_string())
+
+    return 1 if compDf['regression'].any() else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,24 +1,68 @@
+import os
+import copy
+import time
+import queue
+import pickle
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 import datetime
+import multiprocessing as mp
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from dateutil.relativedelta import relativedelta
 
-# ARIMA
-from pmdarima import ARIMA
-
-# statistics
-from scipy.stats import boxcox
-from scipy.special import inv_boxcox
-import statsmodels.api as sm
+# pmdarima, scipy and statsmodels take seconds to import, so they are
+# imported where used.  Workers that only load and predict never pay for
+# statsmodels.api.
 
 # My stuff
 from base_config import BaseConfig
+from seasonality import learnSeasonalProfiles, learnWeeklyProfiles, hourOfWeek
+from global_trend import fitGlobalTrends, globalTrendSummary
+from instrumentation import getLogger, span, timed
+from batch_runner import singleThreadedBlas
+
+logger = getLogger(__name__)
+
+
+# Bump whenever the layout written by DecomposedArima.save changes, and teach
+# _upgradeArtifact the previous one.
+#   1: daily models, first layout.
+#   2: adds arimaEngine, resolution and the hourly weekly Fourier profile.
+ARTIFACT_FORMAT_VERSION = 2
+
+# Plain attributes stored as-is in a saved model.
+_ARTIFACT_ATTRIBUTES = [
+    # Config and data range
+    'runId', 'dataPath', 'outPath', 'metric', 'minDateData', 'maxDateData',
+    'numDaysPred', 'cachePath', 'chunkSize', 'imputeVal', 'resolution',
+    'firstObservedDate', 'lastObservedDate', 'maxForecastEndDate',
+    # Learned and manually set parameters
+    'boxCoxLambda', 'manualBoxCox',
+    'globalSlope', 'globalIntercept', 'globalTrendExponent',
+    '_globalTrendSummary', 'manualCarryingCapacity', 'carryingCapacity',
+    'numFourierComponents', 'numSeasonalYears',
+    'numWeeklyFourierComponents', 'numSeasonalWeeks',
+    'arimaOrder', 'arimaSeasonalOrder', '_arimaSummary', 'arimaEngine',
+    'isTrendLearned', 'isTrained',
+    'trendRefreshDays', 'updateMaxIter', 'trendLearnedThrough',
+]
+
+# Most trend and seasonal components one model keeps, see _cachedComponent.
+_COMPONENT_CACHE_SIZE = 8
+
+# Fitting engines for the ARIMA step.  'numpy' is sarima.SeasonalArima, which
+# only supports p, q, P and Q of at most 1 but fits several times faster.
+arimaEngines = ['pmdarima', 'numpy']
 
 
 class DecomposedArima(BaseConfig):
     r"""
     An ARIMA model which is decomposed into global trend + fourier + ARIMA.
+
+    With resolution='hourly' the trend and yearly seasonality are still
+    learned from daily means, a second Fourier profile over the hours of the
+    week adds the daily and weekly seasonality, and ARIMA is non-seasonal.
     """
 
     def __init__(self,
@@ -29,10 +73,16 @@ class DecomposedArima(BaseConfig):
                  minDateData=None,  # infer
                  maxDateData=None,  # infer
                  numDaysPred=30,
-                 detectAnomalies=False):
-
-        print('Initializing V3 model.  Set instance attirbutes directly or they'
-              ' will be inferred.')
+                 detectAnomalies=False,
+                 cachePath=None,
+                 chunkSize=None,
+                 dailyData=None,
+                 dtype='float64',
+                 arimaEngine='pmdarima',
+                 resolution='daily'):
+
+        logger.info('Initializing V3 model.  Set instance attirbutes directly '
+                    'or they will be inferred.')
         # Initalize dataset
         super().__init__(dataPath=dataPath,
                          outPath=outPath,
@@ -41,7 +91,23 @@ class DecomposedArima(BaseConfig):
                          minDateData=minDateData,
                          maxDateData=maxDateData,
                          numDaysPred=numDaysPred,
-                         detectAnomalies=detectAnomalies)
+                         detectAnomalies=detectAnomalies,
+                         cachePath=cachePath,
+                         chunkSize=chunkSize,
+                         dailyData=dailyData,
+                         dtype=dtype,
+                         resolution=resolution)
+
+        self._initModelParams()
+        self.arimaEngine = arimaEngine
+
+        if self.resolution == 'hourly':
+            # A seasonal lag of 24 or 168 hours makes the state space huge.
+            # weeklyTrend carries that seasonality instead.
+            self.arimaSeasonalOrder = (0, 0, 0, 0)
+
+    def _initModelParams(self):
+        r""" Set every model parameter to its default, unlearned value. """
 
         # Boxcox stuff
         self.boxCoxLambda = None
@@ -57,12 +123,23 @@ class DecomposedArima(BaseConfig):
 
         # Seasonal trend stuff
         self.numFourierComponents = 3
+        # Full years the Fourier spectrum is averaged over.
+        self.numSeasonalYears = 1
         self.seasonalTrend = None
+        # seasonalTrend laid out by month-day, for fast tiling.
+        self.seasonalLookup = None
+        # Hourly only: Fourier profile by hour of week, learned from the
+        # numSeasonalWeeks full weeks before the last observation.
+        self.numWeeklyFourierComponents = 6
+        self.numSeasonalWeeks = 8
+        self.weeklyTrend = None
 
         # ARIMA stuff
         self.arimaOrder = (1, 0, 1)
         self.arimaSeasonalOrder = (1, 1, 1, 7)
         self.arimaSummary = None
+        # One of arimaEngines.
+        self.arimaEngine = 'pmdarima'
 
         # True iff boxcox, global, and seasonal have been learned
         self.isTrendLearned = False
@@ -70,15 +147,34 @@ class DecomposedArima(BaseConfig):
         self.isTrained = False
         self.currentModel = None
 
+        # Trend and seasonal components by date range, see _cachedComponent.
+        self._componentCache = OrderedDict()
+        self._componentCacheState = None
+
+        # Incremental update stuff
+        # update() relearns the trend once it is this many days stale.
+        self.trendRefreshDays = 30
+        # Optimizer iterations when updating ARIMA.  Zero only filters the
+        # new observations with the current parameters.
+        self.updateMaxIter = 0
+        self.trendLearnedThrough = None
+
     ########################################
     # Methods for learning trend parameters.
     ########################################
 
+    @timed()
     def learnTrendParams(self):
         r""" Learn all trend parameters.  """
-        tsData = self.dataset[self.metric]
+        tsData = self.datasetSeries
+
+        logger.info('Learning and saving trend parameters.')
+
+        self._clearComponentCache()
 
-        print('Learning and saving trend parameters.')
+        if self.resolution == 'hourly':
+            hourlyData = tsData
+            tsData = self._dailyMeans(tsData)
 
         # These depend on each other, so we have to learn them in sequence.
         rollingData = self.getRollingAvg(tsData)
@@ -87,7 +183,19 @@ class DecomposedArima(BaseConfig):
         detrendData = self.learnGlobalTrend(bcRolling)
         self.learnSeasonalTrend(detrendData)
 
+        if self.resolution == 'hourly':
+            self.learnWeeklyTrend(hourlyData)
+
         self.isTrendLearned = True
+        self.trendLearnedThrough = self.lastObservedDate
+
+    def _dailyMeans(self, tsData):
+        r""" Daily means of tsData, which the trend is learned from. """
+
+        if self.resolution == 'daily':
+            return tsData
+
+        return tsData.resample('D').mean()
 
     def getRollingAvg(self, tsData):
         r""" Centered 7 day rolling average. """
@@ -103,7 +211,9 @@ class DecomposedArima(BaseConfig):
         """
         self.manualBoxCox = True
         self.boxCoxLambda = val
+        self._clearComponentCache()
 
+    @timed()
     def learnBoxCoxParam(self, tsData):
         r"""
         Find and store the optimal value of lambda for Box-Cox transformation.
@@ -112,8 +222,10 @@ class DecomposedArima(BaseConfig):
         assumption.
         """
 
+        from scipy.stats import boxcox
+
         if self.manualBoxCox:
-            print('Using manually set Box-Cox parameter.')
+            logger.info('Using manually set Box-Cox parameter.')
 
             if self.boxCoxLambda is None:
                 raise RuntimeError('Box-Cox lambda was never set, even though \
@@ -122,7 +234,7 @@ class DecomposedArima(BaseConfig):
             bcRolling = boxcox(tsData, lmbda=self.boxCoxLambda)
 
         else:
-            print('Learning Box-Cox parameter.')
+            logger.info('Learning Box-Cox parameter.')
 
             bcRolling, optimalLmda = boxcox(tsData)
 
@@ -132,40 +244,61 @@ class DecomposedArima(BaseConfig):
 
             self.boxCoxLambda = optimalLmda
 
+        self._clearComponentCache()
+
         return pd.Series(bcRolling, index=tsData.index)
 
+    @timed()
     def learnGlobalTrend(self, tsData):
         r"""
         Train OLS regression on Box-Cox transformed rolling average.
 
-        Stores slope, intercept, and summary string.
+        Stores slope and intercept.  The summary is built when
+        globalTrendSummary is first read.
         """
 
-        print('Learning global trend.')
+        logger.info('Learning global trend.')
 
         X = np.arange(0, tsData.shape[0])
 
         XPow = X**self.globalTrendExponent
-        m, b = np.polyfit(XPow, tsData, deg=1)
+        m, b, _ = fitGlobalTrends(tsData.values, self.globalTrendExponent)
         G = m*XPow + b
 
-        # Now fit statsmodels OLS to get summary.
-        df = pd.DataFrame({
-            'x_pow': XPow,
-            'intercept': 1
-        })
-
-        linear_model = sm.OLS(tsData.values, df)
-        statsLR = linear_model.fit()
-
         self.globalSlope = m
         self.globalIntercept = b
-        self.globalTrendSummary = statsLR.summary2().as_text()
+        self.globalTrendSummary = None
+        self._clearComponentCache()
 
         globalTrend = pd.Series(G, tsData.index)
 
         return tsData - globalTrend
 
+    @property
+    def globalTrendSummary(self):
+        r""" OLS summary text of the global trend, built on first read. """
+
+        if self._globalTrendSummary is None and self.globalSlope is not None:
+            self._globalTrendSummary = globalTrendSummary(
+                self._globalTrendSourceData(), self.globalTrendExponent)
+
+        return self._globalTrendSummary
+
+    @globalTrendSummary.setter
+    def globalTrendSummary(self, val):
+        self._globalTrendSummary = val
+
+    def _globalTrendSourceData(self):
+        r"""
+        The Box-Cox data the global trend was learned from, rebuilt from the
+        dataset up to trendLearnedThrough rather than kept on the model.
+        """
+
+        tsData = self.datasetSeries.loc[:self.trendLearnedThrough]
+
+        return self.boxCoxTransform(
+            self.getRollingAvg(self._dailyMeans(tsData)))
+
     def setCarryingCapacity(self, val):
         r"""
         Manually set carrying capacity.
@@ -175,7 +308,9 @@ class DecomposedArima(BaseConfig):
         """
         self.manualCarryingCapacity = True
         self.carryingCapacity = val
+        self._clearComponentCache()
 
+    @timed()
     def learnCarryingCapacity(self, tsData):
         r"""
         Set carrying capacity based on values of rolling average of dataset.
@@ -184,54 +319,72 @@ class DecomposedArima(BaseConfig):
         """
 
         if self.manualCarryingCapacity:
-            print('Using manually set carrying capacity.')
+            logger.info('Using manually set carrying capacity.')
 
         else:
-            print('Estimating carrying capacity.')
+            logger.info('Estimating carrying capacity.')
 
             self.carryingCapacity = 2.2*tsData.max()
 
+        self._clearComponentCache()
+
+    @timed()
     def learnSeasonalTrend(self, tsData):
-        r""" Use Fourier transform to model seasonal trend.  """
+        r"""
+        Use Fourier transform to model seasonal trend.
 
-        print('Learning seasonal trend.')
+        Learned from the numSeasonalYears full years before the last one.
+        """
 
-        lastYear = str(tsData
-                       .dropna()
-                       .index
-                       .max()
-                       .year - 1)
+        logger.info('Learning seasonal trend.')
 
-        lastYearData = tsData.loc[lastYear]
-        idx = lastYearData.index
+        fourierSum = learnSeasonalProfiles(
+            tsData,
+            numFourierComponents=self.numFourierComponents,
+            numYears=self.numSeasonalYears
+        )
 
-        fftData = np.fft.fft(lastYearData)
-        fftFiltered = self._topComponentFilter(fftData)
+        self.seasonalTrend = pd.Series(fourierSum.values,
+                                       index=fourierSum.index)
+        self.seasonalLookup = self._buildSeasonalLookup(self.seasonalTrend)
+        self._clearComponentCache()
 
-        fourierSum = np.fft.ifft(fftFiltered).real
+    @timed()
+    def learnWeeklyTrend(self, tsData):
+        r"""
+        Use Fourier transform to model the daily and weekly seasonality of
+        hourly data, left after the global trend and yearly seasonality.
 
-        self.seasonalTrend = pd.Series(fourierSum, index=idx)
+        Learned from the last numSeasonalWeeks full weeks.
+        """
 
-    def _topComponentFilter(self, Z, threshold=12):
-        Z_filtered = Z.copy()  # necessary to copy?  I don't want any side effects
+        logger.info('Learning weekly trend.')
 
-        # kill high frequency components to avoid weekly seasonality dominating
-        Z_filtered[range(threshold+1, len(Z_filtered))] = 0
+        self.weeklyTrend = None
+        residualData = self.subtractSeasonality(
+            self.subtractGlobalTrend(self.boxCoxTransform(tsData)))
 
-        if self.numFourierComponents == 0:
-            # If numFourierComponents is zero, null out everything
-            Z_filtered = np.zeros(Z.shape)
-        else:
-            # indices of all but top weighted components
-            inds = (np.abs(Z_filtered)
-                    .argsort()[: -self.numFourierComponents])
+        self.weeklyTrend = learnWeeklyProfiles(
+            residualData,
+            numFourierComponents=self.numWeeklyFourierComponents,
+            numWeeks=self.numSeasonalWeeks
+        )
+        # The residuals cached the seasonal component without it.
+        self._clearComponentCache()
 
-            Z_filtered[inds] = 0
+    def getFreshARIMA(self):
+        r""" Returns an untrained model of arimaEngine. """
 
-        return Z_filtered
+        if self.arimaEngine not in arimaEngines:
+            raise ValueError('Unknown ARIMA engine %s.' % self.arimaEngine)
 
-    def getFreshARIMA(self):
-        r""" Returns an untrained model. """
+        if self.arimaEngine == 'numpy':
+            from sarima import SeasonalArima
+
+            return SeasonalArima(order=self.arimaOrder,
+                                 seasonal_order=self.arimaSeasonalOrder)
+
+        from pmdarima import ARIMA
 
         return ARIMA(
             order=self.arimaOrder,
@@ -244,6 +397,7 @@ class DecomposedArima(BaseConfig):
     # Methods for transforming data to ARIMA space.
     ###############################################
 
+    @timed()
     def toArimaSpace(self, tsData):
         r"""
         Transform data to ARIMA space, i.e., Box-Cox transform, then subtract
@@ -266,6 +420,8 @@ class DecomposedArima(BaseConfig):
         if self.boxCoxLambda is None:
             raise RuntimeError('Box-Cox lambda has not been learned or set.')
 
+        from scipy.stats import boxcox
+
         bcVals = boxcox(tsData, lmbda=self.boxCoxLambda)
 
         return pd.Series(bcVals, index=tsData.index)
@@ -273,7 +429,9 @@ class DecomposedArima(BaseConfig):
     def subtractGlobalTrend(self, tsData):
         r""" Subtract global trend from tsData.  """
 
-        globalTrend = self._yieldLinearTrend(tsData.index)
+        globalTrend = self._cachedComponent('linear',
+                                            tsData.index,
+                                            self._yieldLinearTrend)
 
         return tsData - globalTrend
 
@@ -287,11 +445,8 @@ class DecomposedArima(BaseConfig):
         if idx.max() > self.lastObservedDate or idx.min() < self.firstObservedDate:
             raise RuntimeError('Index outside allowed range.')
 
-        # Get index of min date, where zero is firstObservedDate.
-        startX = (idx.min() - self.firstObservedDate).days
-
-        # Construct regressor
-        X = np.arange(startX, startX + len(idx))
+        # Construct regressor, in days where zero is firstObservedDate.
+        X = self._daysAfter(self.firstObservedDate, idx)
 
         Xpow = X**self.globalTrendExponent
         globalTrend = self.globalSlope*Xpow + self.globalIntercept
@@ -304,7 +459,9 @@ class DecomposedArima(BaseConfig):
         difference.
         """
 
-        seasonalTrend = self._yieldSeasonalTrend(tsData.index)
+        seasonalTrend = self._cachedComponent('seasonal',
+                                              tsData.index,
+                                              self._yieldSeasonalTrend)
 
         return tsData - seasonalTrend
 
@@ -314,43 +471,56 @@ class DecomposedArima(BaseConfig):
         if self.seasonalTrend is None:
             raise RuntimeError('Seasonal trend has not been learned.')
 
-        def getMonthDay(dateTime):
-            return dateTime.strftime('%m-%d')
-
-        # Dataframe of just month and day.
-        idxDates = pd.Series(idx, index=idx).apply(getMonthDay)
-        tmpMonthDay = pd.DataFrame({'tmpMonthDay': idxDates})
-
-        # Fourier sum and tmpMonthDay
-        fourierIdx = self.seasonalTrend.index
-        fourierDates = pd.Series(
-            fourierIdx, index=fourierIdx).apply(getMonthDay)
-        fourierDf = pd.DataFrame({
-            'FourierSum': self.seasonalTrend,
-            'tmpMonthDay': fourierDates
-        })
-
-        fourierTiledDf = (tmpMonthDay
-                          .reset_index()
-                          .merge(fourierDf,
-                                 left_on='tmpMonthDay',
-                                 right_on='tmpMonthDay',
-                                 how='left')
-                          .set_index('Date'))
-
-        # Lag 1 and fill nulls with previous day.  This imputes missing values
-        # for leap year days.
-        fourierTiledDf['lag'] = fourierTiledDf['FourierSum'].shift(1)
-        fourierTiledDf.loc[fourierTiledDf['FourierSum'].isnull(), 'FourierSum'] = (
-            fourierTiledDf.loc[fourierTiledDf['FourierSum'].isnull(), 'lag']
-        )
+        if self.seasonalLookup is None:
+            self.seasonalLookup = self._buildSeasonalLookup(self.seasonalTrend)
+
+        fourierSum = self.seasonalLookup[self._leapDayOfYear(idx)]
+
+        # Lag 1 day and fill nulls with previous day.  This imputes missing
+        # values for leap year days.
+        missing = np.isnan(fourierSum)
+        if missing.any():
+            lagSteps = self.stepsPerDay
+            lag = np.concatenate([np.full(lagSteps, np.nan),
+                                  fourierSum[:-lagSteps]])
+            fourierSum[missing] = lag[missing]
+
+        if self.weeklyTrend is not None:
+            fourierSum += self.weeklyTrend.values[hourOfWeek(idx)]
+
+        return pd.Series(fourierSum, index=idx, name='FourierSum')
+
+    def _buildSeasonalLookup(self, seasonalTrend):
+        r"""
+        Lay seasonalTrend out as an array of 366 month-days (Feb 29 included),
+        with nan for any month-day seasonalTrend does not cover.
+        """
 
-        return fourierTiledDf['FourierSum']
+        lookup = np.full(366, np.nan)
+        lookup[self._leapDayOfYear(seasonalTrend.index)] = seasonalTrend.values
+
+        return lookup
+
+    @staticmethod
+    def _daysAfter(date, idx):
+        r""" Days from date to each date of idx, fractional for hours. """
+
+        return np.asarray((idx - date) / pd.Timedelta(days=1))
+
+    @staticmethod
+    def _leapDayOfYear(idx):
+        r""" Zero based day of year of each date, as if every year were leap. """
+
+        monthStarts = np.array([0, 31, 60, 91, 121, 152,
+                                182, 213, 244, 274, 305, 335])
+
+        return monthStarts[idx.month.values - 1] + idx.day.values - 1
 
     ######################################################
     # Methods for transforming data back from ARIMA space.
     ######################################################
 
+    @timed()
     def backFromArimaSpace(self, tsData):
         r"""
         Back-transform data from the ARIMA prediction space to raw metric.
@@ -371,6 +541,8 @@ class DecomposedArima(BaseConfig):
         if self.boxCoxLambda is None:
             raise RuntimeError('Box-Cox lambda has not been learned or set.')
 
+        from scipy.special import inv_boxcox
+
         rawVals = inv_boxcox(bcData, self.boxCoxLambda)
 
         return pd.Series(rawVals, index=bcData.index)
@@ -378,7 +550,9 @@ class DecomposedArima(BaseConfig):
     def addGlobalTrend(self, tsData):
         r""" Add global trend to tsData. """
 
-        globalTrend = self._yieldGlobalTrend(tsData.index)
+        globalTrend = self._cachedComponent('global',
+                                            tsData.index,
+                                            self._yieldGlobalTrend)
 
         return tsData + globalTrend
 
@@ -393,6 +567,9 @@ class DecomposedArima(BaseConfig):
         if maxDate <= self.lastObservedDate:
             globalTrend = self._yieldLinearTrend(idx)
 
+        elif idx.min() > self.lastObservedDate:
+            globalTrend = self._yieldLogisticTrend(idx)
+
         else:
             # In this case, the data spills over into the test set, where we
             # assume the linear trend starts to decay.
@@ -423,45 +600,20 @@ class DecomposedArima(BaseConfig):
         if idx.min() <= self.lastObservedDate:
             raise RuntimeError('Index outside allowed range.')
 
-        # Get index of min date, where zero is lastObservedDate.
-        startX = (idx.min() - self.lastObservedDate).days
-
-        numDaysTrain = (self.lastObservedDate
-                        - self.firstObservedDate
-                        + relativedelta(days=1)).days
+        numDaysTrain = self._daysAfter(self.firstObservedDate,
+                                       self.lastObservedDate) + 1
 
         # This is the value of the "linear" trend on self.lastObservedDate.
         valueAtZero = self.globalSlope * \
             (numDaysTrain - 1) + self.globalIntercept
 
-        #############################
-        # Derive Logistic parameters.
-        #############################
-        # This seems version-related, but boxcox can't handle a single float
-        # input... So we do it manually.
-        if self.carryingCapacity == 0:
-            horizAsymptote = np.log(self.carryingCapacity)
-        else:
-            horizAsymptote = (
-                (self.carryingCapacity**self.boxCoxLambda - 1)
-                / self.boxCoxLambda
-            )
-
-        # Continuous growth rate of logistic curve
-        r = (
-            (horizAsymptote * self.globalSlope)
-            / ((horizAsymptote - valueAtZero) * valueAtZero)
-        )
-
-        ###################################
-        # Apply logistic equation to range.
-        ###################################
-        Xs = np.arange(startX, startX + len(idx))
-        num = horizAsymptote * valueAtZero
-        denom = valueAtZero + (horizAsymptote - valueAtZero) * np.exp(-r*Xs)
-
-        # Logistic curve as numpy array
-        Ys = num*(denom**(-1))
+        # Days after lastObservedDate.
+        Xs = self._daysAfter(self.lastObservedDate, idx)
+        Ys = logisticTrend(Xs,
+                           self.globalSlope,
+                           valueAtZero,
+                           self.carryingCapacity,
+                           self.boxCoxLambda)
 
         return pd.Series(Ys, index=idx)
 
@@ -471,34 +623,335 @@ class DecomposedArima(BaseConfig):
         sum.
         """
 
-        seasonalTrend = self._yieldSeasonalTrend(tsData.index)
+        seasonalTrend = self._cachedComponent('seasonal',
+                                              tsData.index,
+                                              self._yieldSeasonalTrend)
 
         return tsData + seasonalTrend
 
+    def backFromArimaSpaceBatch(self, df, columns=None):
+        r"""
+        Back-transform several ARIMA space columns of df at once.
+
+        Same values as backFromArimaSpace on each column, but the seasonal and
+        global trend are only built once.  Returns a frame with columns.
+        """
+
+        if not self.isTrendLearned:
+            raise RuntimeError('Trend has not been learned.')
+
+        if self.boxCoxLambda is None:
+            raise RuntimeError('Box-Cox lambda has not been learned or set.')
+
+        if columns is None:
+            columns = list(df.columns)
+
+        seasonalTrend = self._cachedComponent('seasonal',
+                                              df.index,
+                                              self._yieldSeasonalTrend)
+        globalTrend = self._cachedComponent('global',
+                                            df.index,
+                                            self._yieldGlobalTrend)
+
+        from scipy.special import inv_boxcox
+
+        # Same order of operations as addSeasonality, then addGlobalTrend.
+        bcVals = ((df[columns].values + seasonalTrend.values[:, None])
+                  + globalTrend.values[:, None])
+
+        return pd.DataFrame(inv_boxcox(bcVals, self.boxCoxLambda),
+                            index=df.index,
+                            columns=columns)
+
+    def _cachedComponent(self, kind, idx, yieldFunc):
+        r"""
+        yieldFunc(idx), memoized by kind and date range.
+
+        Only contiguous indexes, one row per step, are cached, and only the
+        _COMPONENT_CACHE_SIZE most recently used.  The setters and learn
+        methods clear the cache, and it is also dropped when any parameter
+        in _componentState was set directly.
+        """
+
+        if len(idx) == 0 or (idx[-1] - idx[0]) // self.step + 1 != len(idx):
+            return yieldFunc(idx)
+
+        state = self._componentState()
+        if state != self._componentCacheState:
+            self._clearComponentCache()
+            self._componentCacheState = state
+
+        key = (kind, idx[0], idx[-1])
+        if key in self._componentCache:
+            self._componentCache.move_to_end(key)
+            return self._componentCache[key]
+
+        component = yieldFunc(idx)
+        self._componentCache[key] = component
+        while len(self._componentCache) > _COMPONENT_CACHE_SIZE:
+            self._componentCache.popitem(last=False)
+
+        return component
+
+    def _clearComponentCache(self):
+        r""" Drop every cached component.  Copies sharing it keep theirs. """
+
+        self._componentCache = OrderedDict()
+
+    def _componentState(self):
+        r"""
+        Parameters the components depend on that are commonly set directly.
+        The learned profiles only change through the learn methods.
+        """
+
+        return (self.boxCoxLambda,
+                self.globalSlope,
+                self.globalIntercept,
+                self.globalTrendExponent,
+                self.carryingCapacity,
+                self.firstObservedDate,
+                self.lastObservedDate)
+
+    @timed()
     def fit(self):
         r""" Fit the model.  Returns fit model. """
 
-        print('Fitting model.')
+        logger.info('Fitting model.')
 
         if not self.isTrendLearned:
             self.learnTrendParams()
 
-        tsData = self.dataset[self.metric]
+        tsData = self.datasetSeries
 
         trainEndog = self.toArimaSpace(tsData)
 
         model = self.getFreshARIMA()
 
-        print('Fitting ARIMA.')
+        logger.info('Fitting ARIMA.')
 
-        model.fit(trainEndog)
+        with span('arimaFit'):
+            model.fit(trainEndog)
 
         self.currentModel = model
         self.isTrained = True
-        self.arimaSummary = str(model.summary())
+        # Built from the model when first read.
+        self.arimaSummary = None
+
+        return model
+
+    @property
+    def arimaSummary(self):
+        r""" Summary text of currentModel, built on first read. """
+
+        if self._arimaSummary is None and self.currentModel is not None:
+            self._arimaSummary = str(self.currentModel.summary())
+
+        return self._arimaSummary
+
+    @arimaSummary.setter
+    def arimaSummary(self, val):
+        self._arimaSummary = val
+
+    @timed()
+    def update(self, newData):
+        r"""
+        Append new observations and move the fitted model forward.
+
+        newData is a Series (or a DataFrame with a self.metric column) indexed
+        by date, starting after lastObservedDate.  The ARIMA state is filtered
+        forward over the new observations with the current parameters.  Trend
+        parameters, and with them ARIMA, are only relearned once they are
+        trendRefreshDays old.
+        """
+
+        if isinstance(newData, pd.DataFrame):
+            newData = newData[self.metric]
+
+        newData = newData.copy()
+        newData.index = pd.to_datetime(newData.index).rename('Date')
+        newData = newData.sort_index()
+
+        if newData.index.min() <= self.lastObservedDate:
+            raise RuntimeError('newData must start after lastObservedDate.')
+
+        firstNewDate = self.lastObservedDate + self.step
+        newVals = self._imputeDates(newData.to_frame(self.metric),
+                                    firstNewDate,
+                                    newData.index.max(),
+                                    imputeVal=self.imputeVal)
+
+        logger.info('Appending %d rows.' % len(newVals))
+
+        self.datasetValues = np.concatenate([self.datasetValues, newVals])
+        self.lastObservedDate = self._dateAt(len(self.datasetValues) - 1)
+        self.maxForecastEndDate = (self.lastObservedDate
+                                   + relativedelta(days=self.numDaysPred))
+
+        trendAge = None
+        if self.trendLearnedThrough is not None:
+            trendAge = (self.lastObservedDate - self.trendLearnedThrough).days
+
+        if (not self.isTrained
+                or trendAge is None
+                or trendAge >= self.trendRefreshDays):
+            logger.info('Trend is stale, refitting.')
+            self.isTrendLearned = False
+            return self.fit()
+
+        newEndog = self.toArimaSpace(
+            self.datasetSeries.iloc[-len(newVals):])
+
+        logger.info('Updating ARIMA.')
+
+        model = self.currentModel
+        if self.updateMaxIter > 0:
+            model.update(newEndog, maxiter=self.updateMaxIter)
+        elif self.arimaEngine == 'numpy':
+            model.append(newEndog)
+        else:
+            model.arima_res_ = model.arima_res_.append(newEndog, refit=False)
+
+        self.arimaSummary = None
 
         return model
 
+    @timed()
+    def searchArimaOrder(self,
+                         orders=None,
+                         seasonalOrders=None,
+                         stepwise=False,
+                         scoring='aic',
+                         holdoutDays=30,
+                         numWorkers=None,
+                         timeout=120,
+                         maxiter=50):
+        r"""
+        Search ARIMA orders and keep the best fit in currentModel.
+
+        With stepwise=False every combination of orders and seasonalOrders is
+        scored.  With stepwise=True the search starts at the current orders
+        and moves to the best neighbour (p, q, P or Q one higher or lower)
+        until no neighbour improves; orders and seasonalOrders then only bound
+        the search.  scoring is 'aic', or 'holdout' for the mean absolute
+        ARIMA space error over the last holdoutDays of a fit without them.
+        Hourly models default to non-seasonal orders only.
+
+        Candidates are scored on numWorkers spawned processes with at most
+        maxiter optimizer iterations, and killed after timeout seconds.  The
+        processes live for the whole search, but each first spends a few
+        seconds importing pmdarima, not counted in timeout, so small grids
+        are faster with fewer workers.  Returns a frame of every candidate
+        scored, best first.
+
+        Candidates are always scored with pmdarima, the kept fit is built
+        with arimaEngine.  With the numpy engine, orders it can't fit are left
+        out of the search.
+        """
+
+        if not self.isTrendLearned:
+            self.learnTrendParams()
+
+        if orders is None:
+            orders = [(p, 0, q) for p in range(3) for q in range(3)]
+        if seasonalOrders is None and self.resolution == 'hourly':
+            seasonalOrders = [(0, 0, 0, 0)]
+        elif seasonalOrders is None:
+            seasonalOrders = [(P, 1, Q, 7) for P in range(2) for Q in range(2)]
+
+        allowed = [(tuple(o), tuple(so))
+                   for o in orders for so in seasonalOrders]
+
+        if self.arimaEngine == 'numpy':
+            from sarima import isSupportedOrder
+
+            allowed = [c for c in allowed if isSupportedOrder(*c)]
+            if len(allowed) == 0:
+                raise ValueError('No candidate order is supported by the '
+                                 'numpy engine.')
+
+        if numWorkers is None:
+            numWorkers = os.cpu_count() or 1
+
+        # Transform once, shared by every candidate.
+        trainEndog = self.toArimaSpace(self.datasetSeries)
+
+        scored = {}
+        pool = _ArimaScoringPool(trainEndog,
+                                 scoring,
+                                 holdoutDays * self.stepsPerDay,
+                                 maxiter,
+                                 numWorkers,
+                                 timeout)
+
+        def scoreAll(candidates):
+            candidates = [c for c in candidates if c not in scored]
+            logger.info('Scoring %d ARIMA orders.' % len(candidates))
+            scored.update(pool.score(candidates))
+
+        with pool:
+            if stepwise:
+                allowed = set(allowed)
+                best = (tuple(self.arimaOrder),
+                        tuple(self.arimaSeasonalOrder))
+                scoreAll([best])
+
+                while True:
+                    neighbours = [c for c in _arimaNeighbours(*best)
+                                  if c in allowed]
+                    scoreAll(neighbours)
+
+                    newBest = min([best] + neighbours,
+                                  key=lambda c: _scoreKey(scored[c]))
+                    if newBest == best:
+                        break
+                    best = newBest
+            else:
+                scoreAll(allowed)
+
+        resultDf = (pd.DataFrame(
+            [{'Order': c[0],
+              'SeasonalOrder': c[1],
+              'Score': r['score'],
+              'Status': r['status']} for c, r in scored.items()])
+            .sort_values('Score', na_position='last')
+            .reset_index(drop=True))
+
+        okDf = resultDf[resultDf['Status'] == 'ok']
+        if len(okDf) == 0:
+            raise RuntimeError('No ARIMA order could be fit.')
+
+        bestOrder = okDf['Order'].iloc[0]
+        bestSeasonalOrder = okDf['SeasonalOrder'].iloc[0]
+
+        logger.info('Best ARIMA order: %s %s.'
+                    % (bestOrder, bestSeasonalOrder))
+
+        # getFreshARIMA builds from the current orders, so put them back if
+        # the kept fit fails.
+        oldOrders = (self.arimaOrder, self.arimaSeasonalOrder)
+        self.arimaOrder = bestOrder
+        self.arimaSeasonalOrder = bestSeasonalOrder
+
+        try:
+            if scoring == 'aic':
+                # The candidate was fit on the full data, so reuse its
+                # parameters.
+                params = scored[(bestOrder, bestSeasonalOrder)]['params']
+                model = self._restoreArima(params, np.asarray(trainEndog))
+            else:
+                model = self.getFreshARIMA()
+                model.fit(trainEndog)
+        except Exception:
+            self.arimaOrder, self.arimaSeasonalOrder = oldOrders
+            raise
+
+        self.currentModel = model
+        self.isTrained = True
+        self.arimaSummary = None
+
+        return resultDf
+
+    @timed()
     def predict(self, alpha=0.2):
         r""" Return predictions in and out of sample. """
 
@@ -513,7 +966,7 @@ class DecomposedArima(BaseConfig):
         trainPreds = fitModel.predict_in_sample()
 
         trainDf = pd.DataFrame(
-            data={'ArimaInSamplePred': trainPreds},
+            data={'ArimaInSamplePred': np.asarray(trainPreds)},
             index=self._getDateIndex(
                 self.firstObservedDate,
                 self.lastObservedDate
@@ -523,46 +976,44 @@ class DecomposedArima(BaseConfig):
         #########################################################
         # Get out of sample predictions and confidence intervals.
         #########################################################
-        begin = self.lastObservedDate + relativedelta(days=1)
-        end = self.lastObservedDate + relativedelta(days=self.numDaysPred+1)
+        begin = self.lastObservedDate + self.step
+        end = self.lastObservedDate + relativedelta(days=self.numDaysPred)
 
         yPred, predCis = fitModel.predict(
-            n_periods=self.numDaysPred,
+            n_periods=self.numStepsPred,
             return_conf_int=True,
-            alpha=0.2
+            alpha=alpha
         )
 
-        predIdx = predExog.index
+        predIdx = self._getDateIndex(begin, end)
 
         CiColnamePrefix = '%d%%ConfInt' % int(100*(1-alpha))
         forecastDf = pd.DataFrame(
             data={
-                'ArimaOoSamplePred': yPred,
+                'ArimaOoSamplePred': np.asarray(yPred),
                 'Arima' + CiColnamePrefix + 'Lower': predCis[:, 0],
                 'Arima' + CiColnamePrefix + 'Upper': predCis[:, 1]
             },
             index=predIdx
         )
 
-        predDf = (self.dataset[[self.metric]]
+        predDf = (self.datasetSeries.to_frame()
                   .join(trainDf)
                   .join(forecastDf, how='outer'))
 
-        inSamplePreds = self.backFromArimaSpace(predDf['ArimaInSamplePred'])
-        predDf['InSamplePredictions'] = inSamplePreds
-
-        ooSamplePreds = self.backFromArimaSpace(predDf['ArimaOoSamplePred'])
-        predDf['OoSamplePredictions'] = ooSamplePreds
-
-        ciLower = self.backFromArimaSpace(
-            predDf['Arima' + CiColnamePrefix + 'Lower']
-        )
-        predDf[CiColnamePrefix+'Lower'] = ciLower
-
-        ciUpper = self.backFromArimaSpace(
-            predDf['Arima' + CiColnamePrefix + 'Upper']
-        )
-        predDf[CiColnamePrefix+'Upper'] = ciUpper
+        rawDf = self.backFromArimaSpaceBatch(predDf, [
+            'ArimaInSamplePred',
+            'ArimaOoSamplePred',
+            'Arima' + CiColnamePrefix + 'Lower',
+            'Arima' + CiColnamePrefix + 'Upper'
+        ])
+        rawDf.columns = [
+            'InSamplePredictions',
+            'OoSamplePredictions',
+            CiColnamePrefix + 'Lower',
+            CiColnamePrefix + 'Upper'
+        ]
+        predDf = predDf.join(rawDf)
 
         return predDf[[
             self.metric,
@@ -572,43 +1023,243 @@ class DecomposedArima(BaseConfig):
             CiColnamePrefix + 'Upper'
         ]]
 
+    @timed()
+    def predictSimulated(self,
+                         coverages=(50, 80, 95),
+                         numPaths=2000,
+                         chunkSize=500,
+                         seed=None):
+        r"""
+        Predictions with intervals from simulated ARIMA sample paths.
+
+        numPaths paths are drawn in ARIMA space and simulated chunkSize
+        forecast steps at a time.  Each (paths x chunkSize) block is
+        back-transformed and reduced to its quantiles before the next one is
+        drawn, so memory is bounded by numPaths x chunkSize floats whatever
+        the horizon.  Adds SimulatedMedian, SimulatedMean and a
+        '<p>%ConfIntLower/Upper' pair per coverage p to the predict() point
+        forecasts.
+
+        Draws outside the Box-Cox domain, which the inverse transform can't
+        map back, are clipped to its boundary (0 in metric space for a
+        positive lambda), so every path counts in every statistic.  A
+        warning gives the number of paths clipped.
+        """
+
+        if self.isTrained:
+            fitModel = self.currentModel
+        else:
+            fitModel = self.fit()
+
+        trainDf = pd.DataFrame(
+            data={'InSamplePredictions':
+                  np.asarray(fitModel.predict_in_sample())},
+            index=self._getDateIndex(
+                self.firstObservedDate,
+                self.lastObservedDate
+            )
+        )
+        trainDf = self.backFromArimaSpaceBatch(trainDf)
+
+        begin = self.lastObservedDate + self.step
+        end = self.lastObservedDate + relativedelta(days=self.numDaysPred)
+        predIdx = self._getDateIndex(begin, end)
+
+        yPred = np.asarray(fitModel.predict(n_periods=self.numStepsPred))
+
+        # Components broadcast over every path.
+        seasonalTrend = self._cachedComponent('seasonal',
+                                              predIdx,
+                                              self._yieldSeasonalTrend)
+        globalTrend = self._cachedComponent('global',
+                                            predIdx,
+                                            self._yieldGlobalTrend)
+        offset = yPred + seasonalTrend.values + globalTrend.values
+
+        from scipy.special import inv_boxcox
+
+        # inv_boxcox is NaN below -1/lambda for a positive lambda, above it
+        # for a negative one.
+        bcLower, bcUpper = -np.inf, np.inf
+        if self.boxCoxLambda > 0:
+            bcLower = -1 / self.boxCoxLambda
+        elif self.boxCoxLambda < 0:
+            bcUpper = -1 / self.boxCoxLambda
+
+        stateSpace = _arimaStateSpace(fitModel)
+        rng = np.random.default_rng(seed)
+
+        tails = [(100 - coverage) / 2 for coverage in coverages]
+        percentiles = [50] + tails + [100 - tail for tail in tails]
+
+        stats = np.empty((len(percentiles) + 1, self.numStepsPred))
+        clippedPaths = np.zeros(numPaths, dtype=bool)
+
+        blocks = _simulateDeviationBlocks(stateSpace,
+                                          self.numStepsPred,
+                                          numPaths,
+                                          chunkSize,
+                                          rng)
+        for start, deviations in blocks:
+            stop = start + deviations.shape[1]
+
+            bcPaths = deviations + offset[start:stop]
+            outside = (bcPaths < bcLower) | (bcPaths > bcUpper)
+            clippedPaths |= outside.any(axis=1)
+
+            paths = inv_boxcox(np.clip(bcPaths, bcLower, bcUpper),
+                               self.boxCoxLambda)
+
+            stats[:-1, start:stop] = np.percentile(paths, percentiles, axis=0)
+            stats[-1, start:stop] = paths.mean(axis=0)
+
+        if clippedPaths.any():
+            logger.warning('%d of %d simulated paths left the Box-Cox domain '
+                           'and were clipped to its boundary.'
+                           % (clippedPaths.sum(), numPaths))
+
+        simDf = pd.DataFrame(
+            data={
+                'OoSamplePredictions': inv_boxcox(offset, self.boxCoxLambda),
+                'SimulatedMedian': stats[0],
+                'SimulatedMean': stats[-1]
+            },
+            index=predIdx
+        )
+
+        for i, coverage in enumerate(coverages):
+            colnamePrefix = '%d%%ConfInt' % coverage
+            simDf[colnamePrefix + 'Lower'] = stats[1 + i]
+            simDf[colnamePrefix + 'Upper'] = stats[1 + len(coverages) + i]
+
+        return (self.datasetSeries.to_frame()
+                .join(trainDf)
+                .join(simDf, how='outer'))
+
+    @timed()
+    def predictScenarios(self,
+                         carryingCapacities=None,
+                         globalTrendExponents=None,
+                         boxCoxLambdas=None,
+                         numWorkers=1):
+        r"""
+        Out of sample predictions for every combination of the given values.
+
+        Values left as None stay at this model's current setting.  Carrying
+        capacity only enters the logistic extrapolation, so ARIMA is fit once
+        per (boxCoxLambda, globalTrendExponent) pair, on numWorkers
+        processes, and all carrying capacities of a pair are evaluated as one
+        array.  Returns a frame with one row per scenario, indexed by the
+        three values, and one column per forecast date.
+        """
+
+        if not self.isTrendLearned:
+            self.learnTrendParams()
+
+        if carryingCapacities is None:
+            carryingCapacities = [self.carryingCapacity]
+        if globalTrendExponents is None:
+            globalTrendExponents = [self.globalTrendExponent]
+        if boxCoxLambdas is None:
+            boxCoxLambdas = [self.boxCoxLambda]
+
+        pairs = [(lmbda, exponent)
+                 for lmbda in boxCoxLambdas
+                 for exponent in globalTrendExponents]
+
+        # Pairs matching this model reuse its fit, the rest get a clone.
+        scenarioModels = []
+        for lmbda, exponent in pairs:
+            if (lmbda == self.boxCoxLambda
+                    and exponent == self.globalTrendExponent):
+                scenarioModels.append(self)
+                continue
+
+            scenarioModel = self._cloneForCutoff(self.lastObservedDate,
+                                                 self.numDaysPred,
+                                                 refitTrend=True)
+            scenarioModel.setBoxCoxParam(lmbda)
+            scenarioModel.globalTrendExponent = exponent
+            scenarioModels.append(scenarioModel)
+
+        logger.info('Forecasting %d scenarios with %d ARIMA fits.'
+                    % (len(pairs) * len(carryingCapacities), len(pairs)))
+
+        if numWorkers == 1:
+            components = [_scenarioComponents(m) for m in scenarioModels]
+        else:
+            ctx = mp.get_context('spawn')
+            with singleThreadedBlas():
+                with ProcessPoolExecutor(max_workers=numWorkers,
+                                         mp_context=ctx) as pool:
+                    components = list(pool.map(_scenarioComponents,
+                                               scenarioModels))
+
+        begin = self.lastObservedDate + self.step
+        end = self.lastObservedDate + relativedelta(days=self.numDaysPred)
+        predIdx = self._getDateIndex(begin, end)
+
+        numDaysTrain = self._daysAfter(self.firstObservedDate,
+                                       self.lastObservedDate) + 1
+        Xs = self._daysAfter(self.lastObservedDate, predIdx)
+        capacities = np.asarray(carryingCapacities, dtype=float)[:, None]
+
+        from scipy.special import inv_boxcox
+
+        cube = []
+        scenarios = []
+        for (lmbda, exponent), comp in zip(pairs, components):
+            valueAtZero = (comp['globalSlope'] * (numDaysTrain - 1)
+                           + comp['globalIntercept'])
+
+            # (capacities x days), same order of operations as predict.
+            trend = logisticTrend(Xs,
+                                  comp['globalSlope'],
+                                  valueAtZero,
+                                  capacities,
+                                  lmbda)
+            bcVals = (comp['arimaPred'] + comp['seasonal']) + trend
+
+            cube.append(inv_boxcox(bcVals, lmbda))
+            scenarios.extend((lmbda, exponent, capacity)
+                             for capacity in carryingCapacities)
+
+        return pd.DataFrame(
+            np.concatenate(cube),
+            index=pd.MultiIndex.from_tuples(
+                scenarios,
+                names=['boxCoxLambda', 'globalTrendExponent',
+                       'carryingCapacity']
+            ),
+            columns=predIdx
+        )
+
+    @timed()
     def validate(self, maxDate, alpha=0.05):
         r"""
-        Create new DecomposedArima instance with data limited to maxDate,
-        generate predictions from it, and compare to data after maxDate.
+        Copy this model with data limited to maxDate, generate predictions
+        from it, and compare to data after maxDate.
         """
 
-        print('Creating new instance to validate.')
+        logger.info('Creating new instance to validate.')
 
         if maxDate >= self.lastObservedDate:
             raise RuntimeError('maxDate must be less than lastObservedDate.')
 
-        firstPredDate = maxDate + relativedelta(days=1)
-        numDaysVal = (self.lastObservedDate - maxDate).days
-
-        valModel = DecomposedArima(
-            dataPath=self.dataPath,
-            outPath=self.outPath,
-            runId=self.runId,
-            metric=self.metric,
-            minDateData=self.minDateData,
-            maxDateData=maxDate,
-            numDaysPred=numDaysVal
-        )
-
-        # Copy self.dataset in case any manual smoothing was done.
-        valModel.dataset = self.dataset.loc[:maxDate]
+        firstPredDate = maxDate + self.step
+        numDaysVal = int(np.ceil(self._daysAfter(maxDate,
+                                                 self.lastObservedDate)))
 
-        # If Box-Cox lambda was manually set, then do the same here.
-        if self.manualBoxCox:
-            valModel.setBoxCoxParam(self.boxCoxLambda)
+        # Trend is relearned on the truncated data, so nothing after maxDate
+        # leaks into the validation predictions.
+        valModel = self._cloneForCutoff(maxDate, numDaysVal, refitTrend=True)
 
         # Get out of sample predictions.
         valDf = (valModel.predict(alpha=alpha)
                  .drop('InSamplePredictions', axis=1))
 
         # Augment
-        valDf[self.metric] = self.dataset[self.metric]
+        valDf[self.metric] = self.datasetSeries
         valDf.columns = [
             self.metric,
             'ValidationPred',
@@ -617,9 +1268,654 @@ class DecomposedArima(BaseConfig):
         ]
 
         # Attach metrics to validation df.
-        err = valDf[self.metric] - valDf['ValidationPred']
+        valDf = self._attachErrorMetrics(valDf)
+
+        return valDf.loc[firstPredDate:]
+
+    @timed()
+    def backtest(self,
+                 cutoffs=None,
+                 numCutoffs=104,
+                 stepDays=7,
+                 horizonDays=30,
+                 refitTrend=True,
+                 numWorkers=None):
+        r"""
+        Rolling-origin backtest with an expanding training window.
+
+        For each cutoff, fit ARIMA on self.dataset up to the cutoff and
+        forecast horizonDays past it.  cutoffs defaults to numCutoffs dates
+        spaced stepDays apart, the last one horizonDays before
+        lastObservedDate.  Every cutoff relearns the trend and seasonality
+        on its own training data, like validate.  With refitTrend off the
+        ones learned on the full dataset are reused and only the ARIMA part
+        is refit, which is faster but lets every fold see the future.
+
+        Returns one tidy frame with a row per cutoff and forecast date.
+        """
+
+        if cutoffs is None:
+            lastCutoff = (self.lastObservedDate
+                          + relativedelta(days=-horizonDays))
+            cutoffs = [lastCutoff + relativedelta(days=-stepDays*i)
+                       for i in reversed(range(numCutoffs))]
+
+        cutoffs = [pd.to_datetime(c) for c in cutoffs]
+        cutoffs = [c for c in cutoffs
+                   if self.firstObservedDate < c < self.lastObservedDate]
+
+        if len(cutoffs) == 0:
+            raise RuntimeError('No cutoffs inside the observed date range.')
+
+        if not refitTrend:
+            logger.warning('Backtesting with the trend learned on the full '
+                           'dataset, errors will look better than they are.')
+            if not self.isTrendLearned:
+                self.learnTrendParams()
+
+        logger.info('Backtesting %d cutoffs.' % len(cutoffs))
+
+        valModels = [self._cloneForCutoff(c, horizonDays, refitTrend)
+                     for c in cutoffs]
+
+        if numWorkers is None:
+            numWorkers = os.cpu_count() or 1
+
+        if numWorkers == 1:
+            forecasts = [_forecastFromCutoff(m) for m in valModels]
+        else:
+            ctx = mp.get_context('spawn')
+            with singleThreadedBlas():
+                with ProcessPoolExecutor(max_workers=numWorkers,
+                                         mp_context=ctx) as pool:
+                    forecasts = list(pool.map(_forecastFromCutoff,
+                                              valModels))
+
+        btDf = pd.concat(
+            [pd.DataFrame({'Cutoff': c,
+                           'Horizon': (f.index - c) // self.step,
+                           'ValidationPred': f.values},
+                          index=f.index)
+             for c, f in zip(cutoffs, forecasts)]
+        )
+        btDf.index.name = 'Date'
+
+        btDf = (btDf
+                .join(self.datasetSeries.to_frame(), how='inner')
+                .reset_index())
+
+        btDf = self._attachErrorMetrics(btDf)
+
+        return btDf[[
+            'Cutoff',
+            'Date',
+            'Horizon',
+            self.metric,
+            'ValidationPred',
+            'AbsoluteError',
+            'SquaredError',
+            'PercentError'
+        ]]
+
+    def _cloneForCutoff(self, maxDate, numDaysPred, refitTrend=True):
+        r"""
+        Copy of this model with data limited to maxDate, not yet fit.
+
+        Manually set parameters carry over.  Learned trend parameters carry
+        over unless refitTrend is set.
+        """
+
+        valModel = copy.copy(self)
+
+        # Copy the values in case any manual smoothing was done.
+        numSteps = min(self._stepOffset(maxDate) + 1, len(self.datasetValues))
+        valModel.datasetValues = self.datasetValues[:numSteps].copy()
+        valModel.maxDateData = maxDate
+        valModel.lastObservedDate = self._dateAt(numSteps - 1)
+        valModel.numDaysPred = numDaysPred
+        valModel.maxForecastEndDate = (valModel.lastObservedDate
+                                       + relativedelta(days=numDaysPred))
+
+        valModel.currentModel = None
+        valModel.isTrained = False
+        valModel.arimaSummary = None
+
+        # copy.copy shares the cache dict, so give the clone its own.
+        valModel._clearComponentCache()
+        valModel._componentCacheState = None
+
+        if refitTrend:
+            valModel.isTrendLearned = False
+
+        return valModel
+
+    def _attachErrorMetrics(self, valDf, predCol='ValidationPred'):
+        r""" Add absolute, squared and percent error columns. """
+
+        err = valDf[self.metric] - valDf[predCol]
         valDf['AbsoluteError'] = np.abs(err)
         valDf['SquaredError'] = np.square(valDf['AbsoluteError'])
         valDf['PercentError'] = 100*(valDf['AbsoluteError']/valDf[self.metric])
 
-        return valDf.loc[firstPredDate:]
+        return valDf
+
+    ###################################
+    # Methods for saving fitted models.
+    ###################################
+
+    @timed()
+    def save(self, path):
+        r"""
+        Save the model to a compact artifact at path.
+
+        The ARIMA part is stored as its parameters and ARIMA space endog,
+        not as the pickled statsmodels results, which are orders of magnitude
+        larger.  Load with DecomposedArima.load.
+        """
+
+        artifact = {
+            'formatVersion': ARTIFACT_FORMAT_VERSION,
+            'attributes': {name: getattr(self, name)
+                           for name in _ARTIFACT_ATTRIBUTES},
+            'dataset': self.datasetValues,
+            'seasonalTrend': None,
+            'weeklyTrend': None,
+            'arima': None
+        }
+
+        if self.seasonalTrend is not None:
+            artifact['seasonalTrend'] = (self.seasonalTrend.index.min(),
+                                         self.seasonalTrend.values)
+
+        if self.weeklyTrend is not None:
+            artifact['weeklyTrend'] = self.weeklyTrend.values
+
+        if self.currentModel is not None:
+            if self.arimaEngine == 'numpy':
+                params = self.currentModel.params
+                endog = self.currentModel.endog
+            else:
+                results = self.currentModel.arima_res_
+                params = results.params
+                endog = results.model.endog
+
+            artifact['arima'] = {
+                'params': np.asarray(params),
+                'endog': np.asarray(endog).ravel()
+            }
+
+        with open(path, 'wb') as fh:
+            pickle.dump(artifact, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    @timed()
+    def load(cls, path):
+        r""" Load a model written by save.  Does not read the source data. """
+
+        with open(path, 'rb') as fh:
+            artifact = pickle.load(fh)
+
+        artifact = _upgradeArtifact(artifact)
+
+        modelOb = cls.__new__(cls)
+        modelOb._initModelParams()
+
+        for name, val in artifact['attributes'].items():
+            setattr(modelOb, name, val)
+
+        modelOb.datasetStart = modelOb.firstObservedDate
+        modelOb.datasetValues = artifact['dataset']
+        modelOb.datasetDtype = modelOb.datasetValues.dtype
+
+        if artifact['seasonalTrend'] is not None:
+            # Daily at every resolution.
+            start, vals = artifact['seasonalTrend']
+            modelOb.seasonalTrend = pd.Series(
+                vals,
+                index=pd.Index(pd.date_range(start, periods=len(vals)),
+                               name='Date')
+            )
+            modelOb.seasonalLookup = modelOb._buildSeasonalLookup(
+                modelOb.seasonalTrend)
+
+        if artifact['weeklyTrend'] is not None:
+            modelOb.weeklyTrend = pd.Series(
+                artifact['weeklyTrend'],
+                index=pd.RangeIndex(len(artifact['weeklyTrend']),
+                                    name='HourOfWeek')
+            )
+
+        if artifact['arima'] is not None:
+            modelOb.currentModel = modelOb._restoreArima(
+                artifact['arima']['params'],
+                artifact['arima']['endog'])
+
+        return modelOb
+
+    def _restoreArima(self, params, endog):
+        r"""
+        Rebuild a fitted ARIMA by running the Kalman filter over endog with
+        fixed params.  No optimization happens.
+        """
+
+        if self.arimaEngine == 'numpy':
+            return self.getFreshARIMA().filter(endog, params)
+
+        endogSe = pd.Series(
+            endog,
+            index=self._getDateIndex(
+                self.firstObservedDate,
+                self.firstObservedDate + (len(endog) - 1) * self.step
+            )
+        )
+
+        import pmdarima
+        from pmdarima.compat.statsmodels import bind_df_model
+        from statsmodels.tsa.statespace.sarimax import SARIMAX
+
+        model = self.getFreshARIMA()
+
+        sarimax = SARIMAX(
+            endog=endogSe,
+            order=self.arimaOrder,
+            seasonal_order=self.arimaSeasonalOrder,
+            trend=None
+        )
+        model.arima_res_ = sarimax.filter(params)
+
+        # Attributes pmdarima sets in fit and checks in predict.
+        bind_df_model(sarimax, model.arima_res_)
+        model.fit_with_exog_ = False
+        model.nobs_ = len(endog)
+        model.endog_index_ = endogSe.index
+        model.oob_ = np.nan
+        model.oob_preds_ = None
+        model.pkg_version_ = pmdarima.__version__
+
+        return model
+
+
+def _upgradeArtifact(artifact):
+    r"""
+    artifact brought to ARTIFACT_FORMAT_VERSION.  Raises RuntimeError for
+    versions load can't read.
+    """
+
+    version = artifact.get('formatVersion')
+
+    if version == 1:
+        # Daily pmdarima models without a weekly profile.  Attributes missing
+        # from the earliest ones keep their _initModelParams defaults.
+        attributes = dict(artifact['attributes'])
+        attributes.setdefault('arimaEngine', 'pmdarima')
+        attributes.setdefault('resolution', 'daily')
+
+        artifact = dict(artifact,
+                        formatVersion=2,
+                        attributes=attributes,
+                        weeklyTrend=artifact.get('weeklyTrend'))
+        version = 2
+
+    if version != ARTIFACT_FORMAT_VERSION:
+        raise RuntimeError('Unsupported model artifact version %s, '
+                           'expected at most %d.'
+                           % (version, ARTIFACT_FORMAT_VERSION))
+
+    return artifact
+
+
+def logisticTrend(Xs, slope, valueAtZero, carryingCapacity, boxCoxLambda):
+    r"""
+    Decaying logistic continuation of a linear trend, in Box-Cox space.
+
+    Xs are days after the last observation, where the linear trend has
+    valueAtZero and slope.  Every argument broadcasts, so e.g. a column of
+    carrying capacities against a row of Xs gives one curve per row.
+    """
+
+    carryingCapacity = np.asarray(carryingCapacity, dtype=float)
+    boxCoxLambda = np.asarray(boxCoxLambda, dtype=float)
+
+    #############################
+    # Derive Logistic parameters.
+    #############################
+    # The Box-Cox transform of the carrying capacity.  Done manually, as
+    # boxcox can't handle a single float input.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        horizAsymptote = np.where(
+            boxCoxLambda == 0,
+            np.log(carryingCapacity),
+            (carryingCapacity**boxCoxLambda - 1) / boxCoxLambda
+        )
+
+    # Continuous growth rate of logistic curve
+    r = (
+        (horizAsymptote * slope)
+        / ((horizAsymptote - valueAtZero) * valueAtZero)
+    )
+
+    ###################################
+    # Apply logistic equation to range.
+    ###################################
+    num = horizAsymptote * valueAtZero
+    denom = valueAtZero + (horizAsymptote - valueAtZero) * np.exp(-r*Xs)
+
+    return num*(denom**(-1))
+
+
+def _scenarioComponents(scenarioModel):
+    r"""
+    Everything predictScenarios needs from one fit: the ARIMA space
+    forecast, the seasonal trend over the forecast dates and the linear
+    trend parameters.
+    """
+
+    if scenarioModel.isTrained:
+        fitModel = scenarioModel.currentModel
+    else:
+        fitModel = scenarioModel.fit()
+
+    begin = scenarioModel.lastObservedDate + scenarioModel.step
+    end = scenarioModel.lastObservedDate + relativedelta(
+        days=scenarioModel.numDaysPred)
+    predIdx = scenarioModel._getDateIndex(begin, end)
+
+    return {
+        'arimaPred': np.asarray(
+            fitModel.predict(n_periods=scenarioModel.numStepsPred)),
+        'seasonal': scenarioModel._yieldSeasonalTrend(predIdx).values,
+        'globalSlope': scenarioModel.globalSlope,
+        'globalIntercept': scenarioModel.globalIntercept
+    }
+
+
+def _forecastFromCutoff(valModel):
+    r""" Out of sample predictions of a model from _cloneForCutoff. """
+
+    predDf = valModel.predict()
+    firstPredDate = valModel.lastObservedDate + valModel.step
+
+    return predDf.loc[firstPredDate:, 'OoSamplePredictions']
+
+
+def _arimaStateSpace(fitModel):
+    r"""
+    State space matrices of a fit ARIMA of either engine after its last
+    observation, laid out like SeasonalArima.stateSpace.
+    """
+
+    if hasattr(fitModel, 'stateSpace'):
+        return fitModel.stateSpace()
+
+    filterRes = fitModel.arima_res_.filter_results
+
+    return {'design': filterRes.design[:, :, -1],
+            'transition': filterRes.transition[:, :, -1],
+            'selection': filterRes.selection[:, :, -1],
+            'stateCov': filterRes.state_cov[:, :, -1],
+            'obsCov': filterRes.obs_cov[:, :, -1],
+            'predictedState': filterRes.predicted_state[:, -1],
+            'predictedStateCov': filterRes.predicted_state_cov[:, :, -1]}
+
+
+def _simulateDeviationBlocks(stateSpace, numSteps, numPaths, blockSize, rng):
+    r"""
+    numPaths simulated deviations from the point forecast of the state space
+    model from _arimaStateSpace, over numSteps steps.
+
+    Yields (firstStep, block) pairs, each block a (numPaths x blockSize)
+    array (the last one may be shorter).  Only the current block and the
+    paths' states are held.
+
+    The state space model is linear, so the deviations follow the same
+    transition without intercepts, starting from the forecast error of the
+    state after the last observation.  Every step updates all paths at once.
+    """
+
+    design = stateSpace['design']
+    transition = stateSpace['transition']
+    selection = stateSpace['selection']
+    stateCov = stateSpace['stateCov']
+    obsCov = stateSpace['obsCov']
+
+    # The state covariance is singular for the differenced states, so use a
+    # symmetric square root rather than Cholesky.
+    vals, vecs = np.linalg.eigh(stateSpace['predictedStateCov'])
+    initRoot = vecs * np.sqrt(np.clip(vals, 0, None))
+
+    vals, vecs = np.linalg.eigh(stateCov)
+    disturbanceRoot = selection @ (vecs * np.sqrt(np.clip(vals, 0, None)))
+
+    obsStd = np.sqrt(max(obsCov[0, 0], 0))
+
+    numStates = transition.shape[0]
+    states = rng.standard_normal((numPaths, numStates)) @ initRoot.T
+
+    for start in range(0, numSteps, blockSize):
+        with span('simulatePaths'):
+            deviations = np.empty((numPaths, min(blockSize, numSteps - start)))
+            for t in range(deviations.shape[1]):
+                deviations[:, t] = states @ design[0]
+                if obsStd > 0:
+                    deviations[:, t] += obsStd * rng.standard_normal(numPaths)
+
+                shocks = rng.standard_normal((numPaths,
+                                              disturbanceRoot.shape[1]))
+                states = states @ transition.T + shocks @ disturbanceRoot.T
+
+        yield start, deviations
+
+
+def _arimaNeighbours(order, seasonalOrder):
+    r""" Orders with one of p, q, P or Q moved by one. """
+
+    p, d, q = order
+    P, D, Q, m = seasonalOrder
+
+    neighbours = []
+    for step in [-1, 1]:
+        neighbours += [
+            ((p + step, d, q), seasonalOrder),
+            ((p, d, q + step), seasonalOrder),
+            (order, (P + step, D, Q, m)),
+            (order, (P, D, Q + step, m)),
+        ]
+
+    return [c for c in neighbours if min(c[0] + c[1]) >= 0]
+
+
+def _scoreKey(result):
+    r""" Sort key putting failed candidates last. """
+
+    return np.inf if result['status'] != 'ok' else result['score']
+
+
+class _ArimaScoringPool:
+    r"""
+    numWorkers spawned processes scoring (order, seasonalOrder) candidates,
+    killing any candidate that runs longer than timeout seconds.
+
+    A fresh process takes seconds to import pmdarima, so the workers are
+    kept for the whole search, and a candidate's timeout only starts once it
+    is handed to a worker that has finished importing.  A worker killed for
+    a timeout or crash is replaced, paying the import again.
+    """
+
+    def __init__(self,
+                 trainEndog,
+                 scoring,
+                 holdoutDays,
+                 maxiter,
+                 numWorkers,
+                 timeout):
+        # Spawn like the other pools, forking a process with BLAS or pandas
+        # threads running can deadlock the child.
+        self.ctx = mp.get_context('spawn')
+        self.resultQueue = self.ctx.Queue()
+        self.workerArgs = (trainEndog, scoring, holdoutDays, maxiter)
+        self.numWorkers = numWorkers
+        self.timeout = timeout
+
+        self._workers = {}
+        self._ready = []
+        self._nextId = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for workerId in list(self._workers):
+            self._killWorker(workerId)
+        self.resultQueue.close()
+
+    def _startWorker(self):
+        taskQueue = self.ctx.Queue()
+        proc = self.ctx.Process(target=_arimaScoringWorker,
+                                args=(self._nextId, taskQueue, self.resultQueue)
+                                + self.workerArgs)
+        with singleThreadedBlas():
+            proc.start()
+
+        self._workers[self._nextId] = (proc, taskQueue)
+        self._nextId += 1
+
+    def _killWorker(self, workerId):
+        proc, taskQueue = self._workers.pop(workerId)
+        proc.terminate()
+        proc.join()
+        taskQueue.close()
+
+        if workerId in self._ready:
+            self._ready.remove(workerId)
+
+    def score(self, candidates):
+        r""" Dict mapping every candidate to its score, params and status. """
+
+        pending = list(candidates)
+        running = {}
+        results = {}
+
+        while len(self._workers) < min(self.numWorkers, len(pending)):
+            self._startWorker()
+
+        while pending or running:
+            while pending and self._ready:
+                workerId = self._ready.pop()
+                candidate = pending.pop(0)
+                self._workers[workerId][1].put(candidate)
+                running[workerId] = (candidate, time.monotonic())
+
+            try:
+                workerId, candidate, result = self.resultQueue.get(
+                    timeout=0.1)
+                # Ignore late messages from workers already killed.
+                if workerId in self._workers:
+                    if candidate is not None:
+                        results[candidate] = result
+                        running.pop(workerId)
+                    self._ready.append(workerId)
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            for workerId, (proc, _) in list(self._workers.items()):
+                if workerId in running:
+                    candidate, start = running[workerId]
+                    if now - start > self.timeout:
+                        status = 'timeout'
+                    elif proc.exitcode is not None:
+                        # Crashed without reporting back.
+                        status = 'crashed'
+                    else:
+                        continue
+
+                    running.pop(workerId)
+                    results[candidate] = {'score': np.nan,
+                                          'params': None,
+                                          'status': status}
+                    self._killWorker(workerId)
+                    if pending:
+                        self._startWorker()
+
+                elif proc.exitcode is not None:
+                    # Died before taking a candidate, e.g. in its imports.
+                    self._killWorker(workerId)
+
+            if pending and not self._workers:
+                raise RuntimeError('ARIMA scoring workers exited before '
+                                   'taking a candidate.')
+
+        return results
+
+
+def _arimaScoringWorker(workerId,
+                        taskQueue,
+                        resultQueue,
+                        trainEndog,
+                        scoring,
+                        holdoutDays,
+                        maxiter):
+    r"""
+    Process of _ArimaScoringPool: import pmdarima, report ready, then score
+    candidates from taskQueue until killed.
+    """
+
+    # The slow import, done before any candidate's timeout starts.
+    import pmdarima
+
+    resultQueue.put((workerId, None, None))
+
+    while True:
+        candidate = taskQueue.get()
+        resultQueue.put((workerId,
+                         candidate,
+                         _scoreArimaCandidate(trainEndog,
+                                              candidate,
+                                              scoring,
+                                              holdoutDays,
+                                              maxiter)))
+
+
+def _scoreArimaCandidate(trainEndog,
+                         candidate,
+                         scoring,
+                         holdoutDays,
+                         maxiter):
+    r""" Fit one candidate order and return its score. """
+
+    from pmdarima import ARIMA
+
+    order, seasonalOrder = candidate
+
+    model = ARIMA(
+        order=order,
+        seasonal_order=seasonalOrder,
+        with_intercept=False,
+        trend=None,
+        maxiter=maxiter,
+        suppress_warnings=True
+    )
+
+    try:
+        if scoring == 'aic':
+            model.fit(trainEndog)
+            score = model.aic()
+        elif scoring == 'holdout':
+            model.fit(trainEndog.iloc[:-holdoutDays])
+            yPred = model.predict(n_periods=holdoutDays)
+            score = np.mean(np.abs(np.asarray(trainEndog.iloc[-holdoutDays:])
+                                   - np.asarray(yPred)))
+        else:
+            raise RuntimeError('Unknown scoring %s.' % scoring)
+
+        result = {'score': score,
+                  'params': np.asarray(model.arima_res_.params),
+                  'status': 'ok'}
+
+    except Exception as e:
+        result = {'score': np.nan, 'params': None, 'status': repr(e)}
+
+    return result
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+
+
+r"""
+This module fits the global trend of DecomposedArima, a straight line in
+X**globalTrendExponent, to many series and exponents at once.
+
+The least squares line has a closed form in centered sums, so every series
+and every candidate exponent is fit with one matrix product:
+
+    slopes, intercepts, sse = fitGlobalTrends(Y, exponents=[0.5, 1.0, 1.5])
+
+The statsmodels OLS summary of a fit is only built by globalTrendSummary,
+when someone reads it.
+"""
+
+
+def fitGlobalTrends(Y, exponents=1.0):
+    r"""
+    Least squares slope and intercept of every column of Y against
+    arange(len(Y))**exponent, for every exponent, and the residual sums of
+    squares.
+
+    Y is a (days x series) or 1-D array, exponents a scalar or 1-D array.
+    Returns (slopes, intercepts, sse), each shaped exponents x series, with
+    the dimensions of a scalar exponent or 1-D Y dropped.
+    """
+
+    Y = np.asarray(Y, dtype=float)
+    exponents = np.asarray(exponents, dtype=float)
+
+    Y2d = Y.reshape(len(Y), -1)
+    XPow = np.arange(len(Y)) ** exponents.reshape(-1, 1)
+
+    XCentered = XPow - XPow.mean(axis=1, keepdims=True)
+    YMean = Y2d.mean(axis=0)
+    YCentered = Y2d - YMean
+
+    sxx = np.einsum('ij,ij->i', XCentered, XCentered)[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = (XCentered @ YCentered) / sxx
+    intercepts = YMean - slopes * XPow.mean(axis=1, keepdims=True)
+    sse = (YCentered**2).sum(axis=0) - slopes**2 * sxx
+
+    shape = exponents.shape + Y.shape[1:]
+
+    return (slopes.reshape(shape)[()],
+            intercepts.reshape(shape)[()],
+            sse.reshape(shape)[()])
+
+
+def globalTrendSummary(tsData, exponent=1.0):
+    r""" statsmodels OLS summary text of the global trend of tsData. """
+
+    import statsmodels.api as sm
+
+    df = pd.DataFrame({
+        'x_pow': np.arange(0, len(tsData))**exponent,
+        'intercept': 1
+    })
+
+    return sm.OLS(np.asarray(tsData), df).fit().summary2().as_text()
@@ -3,11 +3,16 @@ import numpy as np
 from dateutil.relativedelta import relativedelta
 import datetime
 import os
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 
-from matplotlib import pyplot as plt
-import matplotlib.dates as mdates
-import matplotlib.units as munits
-from IPython import embed
+# matplotlib is imported where a figure is made, so workers that skip the
+# deliverables never load it.
+
+from instrumentation import getLogger, span, timed
+from batch_runner import singleThreadedBlas
+
+logger = getLogger(__name__)
 
 
 r"""
@@ -19,51 +24,131 @@ predict, and summary methods.
 """
 
 
-def generateDeliverable(modelOb):
-    r""" Generate and save all output for delivery.  """
+@timed()
+def generateDeliverable(modelOb, preset='presentation'):
+    r"""
+    Generate and save all output for delivery.
+
+    preset is a key of renderPresets, controlling plot size and resolution.
+    """
 
     # For saving in a systematic way
     modelFilePath = '%s/%s_%s' % (modelOb.outPath,
                                   modelOb.runId,
                                   modelOb.metric)
 
-    print('Training and predicting model.')
+    logger.info('Training and predicting model.')
     predDf = modelOb.predict()
 
-    print('Generating and saving forecast plot.')
-    f, _ = plotForecast(predDf, metric=modelOb.metric)
-    plt.savefig('%s_forecast_plot.png' % modelFilePath)
-    plt.close(f)
-
-    print('Validating model.')
+    logger.info('Validating model.')
     maxDate = modelOb.lastObservedDate + relativedelta(months=-1)
     valDf = modelOb.validate(maxDate)
 
-    print('Plotting validation metrics.')
-    f, _ = plotValidation(valDf, metric=modelOb.metric)
-    plt.savefig('%s_validation_plot.png' % modelFilePath)
-    plt.close(f)
-
-    print('Saving model raw output.')
-    outDf = predDf.join(
-        valDf.drop(
-            [modelOb.metric, 'GREEN', 'YELLOW', 'RED', 'color'],
-            axis=1
-        )
-    )
+    logger.info('Summarizing validation metrics.')
+    valSummary = summarizeValidation(valDf, stepsPerDay=modelOb.stepsPerDay)
+    valSummary['stats'].to_csv('%s_validation_summary.csv' % modelFilePath,
+                               header=False)
+    valSummary['horizonErrors'].to_csv(
+        '%s_validation_horizon.csv' % modelFilePath)
+
+    renderDeliverable(predDf,
+                      valDf,
+                      modelOb.metric,
+                      modelFilePath,
+                      preset=preset,
+                      summary=valSummary)
+
+    logger.info('Saving model raw output.')
+    outDf = predDf.join(valDf.drop(modelOb.metric, axis=1))
     outDf.to_csv('%s_forecast.csv' % modelFilePath)
 
-    print('Saving model summary.')
+    logger.info('Saving model summary.')
     with open('%s_arima_summary.txt' % modelFilePath, 'w') as fh:
         fh.write(modelOb.arimaSummary)
 
-    print('Saving global trend summary.')
+    logger.info('Saving global trend summary.')
     with open('%s_ols_summary.txt' % modelFilePath, 'w') as fh:
         fh.write(modelOb.globalTrendSummary)
 
     return predDf, valDf
 
 
+#######################################
+# Methods for rendering without pyplot.
+#######################################
+# Plot size and resolution for saved deliverables.  'batch' is for nightly
+# runs where nobody looks at most plots.
+renderPresets = {
+    'presentation': {'figSize': (50, 20),
+                     'fontSize': 40,
+                     'lineWidth': 2,
+                     'dpi': 100},
+    'batch': {'figSize': (16, 6.4),
+              'fontSize': 12,
+              'lineWidth': 1,
+              'dpi': 72}
+}
+
+
+def renderDeliverable(predDf,
+                      valDf,
+                      metric,
+                      modelFilePath,
+                      preset='presentation',
+                      summary=None):
+    r"""
+    Render and save the forecast and validation plots.
+
+    Uses the Agg canvas directly, never pyplot, so it is safe to run in many
+    processes at once.
+    """
+
+    settings = dict(renderPresets[preset])
+    dpi = settings.pop('dpi')
+
+    logger.info('Generating and saving forecast plot.')
+    with span('plotForecast'):
+        f, _ = plotForecast(predDf, metric=metric, headless=True, **settings)
+        f.savefig('%s_forecast_plot.png' % modelFilePath, dpi=dpi)
+
+    logger.info('Plotting validation metrics.')
+    with span('plotValidation'):
+        f, _ = plotValidation(valDf,
+                              metric=metric,
+                              summary=summary,
+                              headless=True,
+                              **settings)
+        f.savefig('%s_validation_plot.png' % modelFilePath, dpi=dpi)
+
+
+def renderDeliverables(jobs, numWorkers=None, preset='batch'):
+    r"""
+    Render many deliverables in worker processes.
+
+    jobs is a list of (predDf, valDf, metric, modelFilePath) tuples.  Returns
+    a dict mapping modelFilePath to the error for jobs that failed.
+    """
+
+    failures = {}
+    # Spawn, a forked renderer would inherit pyplot state and BLAS threads.
+    ctx = mp.get_context('spawn')
+    with singleThreadedBlas():
+        with ProcessPoolExecutor(max_workers=numWorkers,
+                                 mp_context=ctx) as pool:
+            futures = {job[3]: pool.submit(renderDeliverable,
+                                           *job,
+                                           preset=preset)
+                       for job in jobs}
+
+            for modelFilePath, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    failures[modelFilePath] = repr(e)
+
+    return failures
+
+
 ######################
 # Methods for plotting
 ######################
@@ -74,6 +159,96 @@ color_red = '#e91e63'
 color_gray = '#282828'
 color_yellow = '#fd971f'
 
+# Validation error bands, in the order np.select checks them.  Days with no
+# percent error (e.g. missing observations) fall through to NONE.
+errorBands = ['GREEN', 'YELLOW', 'RED', 'NONE']
+errorBandColors = np.array([color_green,
+                            color_yellow,
+                            color_red,
+                            color_purple])
+
+
+def summarizeValidation(valDf,
+                        greenYellowThreshold=5,
+                        yellowRedThreshold=15,
+                        horizonBuckets=(7, 14, 30, 90),
+                        stepsPerDay=1):
+    r"""
+    Classify validation days into GREEN/YELLOW/RED error bands and summarize
+    the errors.  Does not modify valDf.
+
+    Horizon is taken from a 'Horizon' column if valDf has one (as backtest
+    frames do), otherwise it is steps since the step before the first
+    validation date.  Either way it is counted in steps, stepsPerDay to a
+    day, and turned into the day of the horizon, so horizonBuckets are the
+    upper edges, in days, of the horizon buckets.
+
+    Returns a dict with the band of every day (a categorical Series), the
+    matching plot colors, the overall stats as a Series and the errors by
+    horizon bucket as a DataFrame.
+    """
+
+    pctErr = valDf['PercentError'].values
+
+    bandCodes = np.select(
+        [pctErr <= greenYellowThreshold,
+         pctErr <= yellowRedThreshold,
+         pctErr > yellowRedThreshold],
+        [0, 1, 2],
+        default=3
+    )
+
+    bands = pd.Series(
+        pd.Categorical.from_codes(bandCodes, categories=errorBands),
+        index=valDf.index,
+        name='Band'
+    )
+
+    bandCounts = np.bincount(bandCodes, minlength=len(errorBands))
+
+    stats = pd.Series({
+        'NumDays': len(valDf),
+        'MAE': valDf['AbsoluteError'].mean(),
+        'RMSE': np.sqrt(valDf['SquaredError'].mean()),
+        'MAPE': valDf['PercentError'].mean()
+    })
+    for band, count in zip(errorBands, bandCounts):
+        stats['Num' + band] = count
+        stats['Pct' + band] = count / max(len(valDf), 1)
+
+    if 'Horizon' in valDf.columns:
+        horizonSteps = valDf['Horizon'].values
+    else:
+        step = pd.Timedelta(days=1) / stepsPerDay
+        horizonSteps = (valDf.index - valDf.index.min()) // step + 1
+
+    horizon = np.ceil(np.asarray(horizonSteps) / stepsPerDay)
+
+    edges = np.concatenate([[0], horizonBuckets, [np.inf]])
+    labels = ['%d-%d' % (lo + 1, hi)
+              for lo, hi in zip(edges[:-2], edges[1:-1])]
+    labels.append('%d+' % (edges[-2] + 1))
+
+    horizonErrors = (pd.DataFrame({
+        'HorizonBucket': pd.cut(horizon, edges, labels=labels),
+        'AbsoluteError': valDf['AbsoluteError'].values,
+        'SquaredError': valDf['SquaredError'].values,
+        'PercentError': valDf['PercentError'].values
+    })
+        .groupby('HorizonBucket', observed=True)
+        .agg(NumDays=('AbsoluteError', 'size'),
+             MAE=('AbsoluteError', 'mean'),
+             MSE=('SquaredError', 'mean'),
+             MAPE=('PercentError', 'mean')))
+    horizonErrors['RMSE'] = np.sqrt(horizonErrors.pop('MSE'))
+
+    return {
+        'band': bands,
+        'color': errorBandColors[bandCodes],
+        'stats': stats,
+        'horizonErrors': horizonErrors
+    }
+
 
 def plotForecast(predDf,
                  metric,
@@ -88,10 +263,13 @@ def plotForecast(predDf,
                  xRange=None,
                  lineWidth=2,
                  titleText=None,
-                 yAxisText=None):
+                 yAxisText=None,
+                 headless=False):
     r"""
     Plot observed, in-sample, and out-of-sample predictions with confidence
     intervals.
+
+    With headless set, the figure is drawn on an Agg canvas without pyplot.
     """
 
     # Axis labels
@@ -132,7 +310,8 @@ def plotForecast(predDf,
                              titleText=titleText,
                              yAxisText=yAxisText,
                              xRange=xRange,
-                             yRange=yRange)
+                             yRange=yRange,
+                             headless=headless)
 
     # Shading between confidence intervals
     if shade_CIs:
@@ -203,9 +382,14 @@ def plotValidation(valDf,
                    titleText=None,
                    yAxisText=None,
                    greenYellowThreshold=5,
-                   yellowRedThreshold=15):
+                   yellowRedThreshold=15,
+                   summary=None,
+                   headless=False):
     r"""
     Plot observed and predicted over the validation set with some decoration.
+
+    summary is the output of summarizeValidation, computed here if not given.
+    With headless set, the figure is drawn on an Agg canvas without pyplot.
     """
 
     # Axis labels
@@ -236,34 +420,18 @@ def plotValidation(valDf,
                              titleText=metric,
                              yAxisText=metric,
                              xRange=xRange,
-                             yRange=yRange)
+                             yRange=yRange,
+                             headless=headless)
 
     ############################################
     # Compute some derived metrics for plotting.
     ############################################
     # We are going to plot each day's prediction via a scatter plot.
     # The colors will be based on the given threshold percentage abs. error.
-    def parse_bools_to_color(x, y, z):
-        if x:
-            return color_green
-        elif y:
-            return color_yellow
-        elif z:
-            return color_red
-        else:
-            return color_purple
-
-    # construct green, yellow, red labels for days in various ranges.
-    valDf['GREEN'] = valDf['PercentError'] <= greenYellowThreshold
-    valDf['YELLOW'] = ((valDf['PercentError'] > greenYellowThreshold)
-                       & (valDf['PercentError'] <= yellowRedThreshold))
-    valDf['RED'] = valDf['PercentError'] > yellowRedThreshold
-
-    valDf['color'] = valDf[['GREEN', 'YELLOW', 'RED']].apply(
-        lambda row: parse_bools_to_color(row[0], row[1], row[2]),
-        axis=1,
-        result_type='reduce'
-    )
+    if summary is None:
+        summary = summarizeValidation(valDf,
+                                      greenYellowThreshold=greenYellowThreshold,
+                                      yellowRedThreshold=yellowRedThreshold)
 
     # Plot Forecast Model
     ax.plot(valDf[metric],
@@ -279,7 +447,7 @@ def plotValidation(valDf,
     ax.scatter(valDf.index,
                valDf[valPredCol],
                label=None,
-               c=valDf['color'],
+               c=summary['color'],
                s=3*fontSize)
 
     ############################
@@ -300,11 +468,30 @@ def initializeFigure(figSize,
                      titleText,
                      yAxisText,
                      xRange,
-                     yRange):
-    r""" Create figure with reasonable defaults. """
+                     yRange,
+                     headless=False):
+    r"""
+    Create figure with reasonable defaults.
+
+    With headless set, the figure is not registered with pyplot, so nothing
+    needs to be closed and it is safe to use from many processes.
+    """
+
+    # Date ticks use the concise converter, which has to be registered before
+    # any dates are plotted.
+    registerDateConverters()
 
     # Initialize figure
-    f, ax = plt.subplots(1, 1, figsize=figSize)
+    if headless:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        f = Figure(figsize=figSize)
+        FigureCanvasAgg(f)
+        ax = f.add_subplot(1, 1, 1)
+    else:
+        from matplotlib import pyplot as plt
+        f, ax = plt.subplots(1, 1, figsize=figSize)
 
     # Label axes
     ax.set_ylabel(yAxisText, fontsize=fontSize)
@@ -327,9 +514,33 @@ def formatDateTicks(f, ax):
     r"""
     Use some reasonable auto-formatting for time-based x ticks.
 
+    The converters are registered once per process by registerDateConverters,
+    which initializeFigure calls.
+    """
+
+    registerDateConverters()
+
+    return f, ax
+
+
+_dateConvertersRegistered = False
+
+
+def registerDateConverters():
+    r"""
+    Register concise date converters with matplotlib, once per process.
+
     Taken from here:
     https://matplotlib.org/3.1.0/gallery/ticks_and_spines/date_concise_formatter.html
     """
+    global _dateConvertersRegistered
+
+    if _dateConvertersRegistered:
+        return
+
+    import matplotlib.dates as mdates
+    import matplotlib.units as munits
+
     formats = ['%y',          # ticks are mostly years
                '%b',     # ticks are mostly months
                '%d',     # ticks are mostly days
@@ -357,7 +568,7 @@ def formatDateTicks(f, ax):
     munits.registry[datetime.date] = converter
     munits.registry[datetime.datetime] = converter
 
-    return f, ax
+    _dateConvertersRegistered = True
 
 
 def setLegend(f, ax, fontSize):
@@ -0,0 +1,452 @@
+import os
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.special import boxcox
+
+from decomp_arima import DecomposedArima
+from ingest import loadDailySeries
+from seasonality import learnSeasonalProfiles
+from global_trend import fitGlobalTrends
+from instrumentation import getLogger, span, timed
+from batch_runner import singleThreadedBlas
+
+logger = getLogger(__name__)
+
+
+r"""
+This module forecasts a hierarchy of related metrics together, e.g.
+MaxConcurrentStreamsOverall and its per-app children.
+
+The hierarchy is a dict mapping each parent metric to its children:
+
+    hierarchy = {'MaxConcurrentStreamsOverall': ['StreamsApp1', 'StreamsApp2']}
+    hf = HierarchicalForecast(hierarchy, dataPath='./data')
+    forecastDf = hf.predict(method='mint')
+
+Every metric is loaded into one aligned (days x metrics) panel.  The trend
+parameters of all metrics are learned in one vectorized pass, the ARIMA part
+of each metric is fit on a process pool, and the forecasts are reconciled so
+children sum to their parent.
+"""
+
+reconciliationMethods = ['bottomUp', 'topDown', 'mint']
+
+# Box-Cox lambdas are searched for in this interval.
+_BOX_COX_BOUNDS = (-4.0, 4.0)
+
+
+class HierarchicalForecast:
+    r"""
+    DecomposedArima models for every metric of a hierarchy, with reconciled
+    forecasts.
+    """
+
+    def __init__(self,
+                 hierarchy,
+                 dataPath='./data',
+                 outPath='./out',
+                 runId='TEST',
+                 minDateData=None,
+                 maxDateData=None,
+                 numDaysPred=30,
+                 cachePath=None,
+                 chunkSize=None):
+        self.hierarchy = hierarchy
+        self.dataPath = dataPath
+        self.outPath = outPath
+        self.runId = runId
+        self.numDaysPred = numDaysPred
+
+        self.nodes, self.bottomNodes = _hierarchyNodes(hierarchy)
+        self.summingMatrix = summingMatrix(hierarchy)
+
+        with span('ingest'):
+            self.panel, self.imputeVals = loadPanel(dataPath,
+                                                    self.nodes,
+                                                    minDateData=minDateData,
+                                                    maxDateData=maxDateData,
+                                                    cachePath=cachePath,
+                                                    chunkSize=chunkSize)
+
+        # Manually set Box-Cox lambdas by metric, see setBoxCoxParam.
+        self.manualBoxCox = {}
+
+        self.models = {}
+        self.basePredictions = {}
+        self.isTrendLearned = False
+        self.isTrained = False
+
+    def setBoxCoxParam(self, val, metrics=None):
+        r""" Manually set the Box-Cox lambda of metrics (default all). """
+
+        for metric in (self.nodes if metrics is None else metrics):
+            self.manualBoxCox[metric] = val
+
+        self.isTrendLearned = False
+
+    @timed()
+    def learnTrendParams(self,
+                         numFourierComponents=3,
+                         numSeasonalYears=1,
+                         globalTrendExponent=1.0):
+        r"""
+        Learn the trend parameters of every metric at once and build their
+        models from the panel.
+        """
+
+        logger.info('Learning trend parameters of %d metrics.'
+                    % len(self.nodes))
+
+        params = learnPanelTrends(self.panel,
+                                  manualBoxCox=self.manualBoxCox,
+                                  numFourierComponents=numFourierComponents,
+                                  numSeasonalYears=numSeasonalYears,
+                                  globalTrendExponent=globalTrendExponent)
+
+        self.models = {}
+        for metric in self.nodes:
+            modelOb = DecomposedArima(
+                dataPath=self.dataPath,
+                outPath=self.outPath,
+                runId=self.runId,
+                metric=metric,
+                numDaysPred=self.numDaysPred,
+                dailyData=(self.panel[[metric]], self.imputeVals[metric])
+            )
+            _setTrendParams(modelOb, params[metric])
+            self.models[metric] = modelOb
+
+        self.isTrendLearned = True
+        self.isTrained = False
+
+    @timed()
+    def fit(self, numWorkers=None):
+        r"""
+        Fit the ARIMA part of every metric on a process pool and keep the
+        unreconciled predictions.
+        """
+
+        if not self.isTrendLearned:
+            self.learnTrendParams()
+
+        if numWorkers is None:
+            numWorkers = os.cpu_count() or 1
+
+        logger.info('Fitting %d metrics on %d workers.'
+                    % (len(self.nodes), numWorkers))
+
+        models = [self.models[metric] for metric in self.nodes]
+
+        if numWorkers == 1:
+            predDfs = [_predictModel(m) for m in models]
+        else:
+            ctx = mp.get_context('spawn')
+            with singleThreadedBlas():
+                with ProcessPoolExecutor(max_workers=numWorkers,
+                                         mp_context=ctx) as pool:
+                    predDfs = list(pool.map(_predictModel, models))
+
+        self.basePredictions = dict(zip(self.nodes, predDfs))
+        self.isTrained = True
+
+        return self.basePredictions
+
+    @timed()
+    def predict(self, method='mint', numWorkers=None):
+        r"""
+        Reconciled out of sample predictions, one column per metric.
+
+        method is one of reconciliationMethods:
+
+        - bottomUp sums the bottom level forecasts up the hierarchy.
+        - topDown splits the top level forecast by the average historical
+          proportions of the bottom level metrics.
+        - mint is minimum trace reconciliation (Wickramasuriya et al. 2019),
+          weighted by the shrunk covariance of the in sample errors.
+        """
+
+        if method not in reconciliationMethods:
+            raise ValueError('Unknown reconciliation method %s.' % method)
+
+        if not self.isTrained:
+            self.fit(numWorkers=numWorkers)
+
+        baseDf = self._baseFrame('OoSamplePredictions').dropna()
+
+        S = self.summingMatrix.values
+
+        if method == 'bottomUp':
+            G = np.zeros(S.T.shape)
+            bottomPos = [self.nodes.index(b) for b in self.bottomNodes]
+            G[np.arange(len(self.bottomNodes)), bottomPos] = 1
+
+        elif method == 'topDown':
+            roots = [n for n in self.nodes if n not in _childSet(self.hierarchy)]
+            if len(roots) != 1:
+                raise RuntimeError('topDown needs a single top level metric.')
+
+            total = self.panel[roots[0]]
+            proportions = (self.panel[self.bottomNodes]
+                           .div(total, axis=0)
+                           .mean()
+                           .values)
+
+            G = np.zeros(S.T.shape)
+            G[:, self.nodes.index(roots[0])] = proportions
+
+        else:
+            residDf = (self.panel[self.nodes]
+                       - self._baseFrame('InSamplePredictions')).dropna()
+            W = shrunkCovariance(residDf.values)
+
+            # G = (S' W^-1 S)^-1 S' W^-1
+            WinvS = np.linalg.solve(W, S)
+            G = np.linalg.solve(S.T @ WinvS, WinvS.T)
+
+        reconciled = baseDf.values @ (S @ G).T
+
+        return pd.DataFrame(reconciled,
+                            index=baseDf.index,
+                            columns=self.nodes)
+
+    def _baseFrame(self, column):
+        r""" column of every unreconciled prediction, one metric per column. """
+
+        return pd.DataFrame({metric: self.basePredictions[metric][column]
+                             for metric in self.nodes})
+
+
+def loadPanel(dataPath,
+              metrics,
+              minDateData=None,
+              maxDateData=None,
+              cachePath=None,
+              chunkSize=None):
+    r"""
+    Daily averages of metrics as one aligned (days x metrics) frame.
+
+    The panel covers the days every metric was observed on, and missing days
+    are imputed with each metric's mean like BaseConfig does.  Returns
+    (panelDf, imputeVals), imputeVals being a Series of those means.
+    """
+
+    dailyDfs = []
+    meanVals = {}
+    for metric in metrics:
+        dailyDf, meanVal = loadDailySeries(dataPath,
+                                           metric,
+                                           cachePath=cachePath,
+                                           chunkSize=chunkSize)
+        dailyDfs.append(dailyDf)
+        meanVals[metric] = meanVal
+
+    firstDate = max(df.index.min() for df in dailyDfs)
+    lastDate = min(df.index.max() for df in dailyDfs)
+
+    if minDateData is not None:
+        firstDate = max(firstDate, pd.to_datetime(minDateData))
+    if maxDateData is not None:
+        lastDate = min(lastDate, pd.to_datetime(maxDateData))
+
+    if firstDate > lastDate:
+        raise RuntimeError('Metrics have no observed days in common.')
+
+    dateIdx = pd.Index(pd.date_range(firstDate, lastDate), name='Date')
+    imputeVals = pd.Series(meanVals)
+
+    panelDf = (pd.concat(dailyDfs, axis=1)
+               .reindex(dateIdx)
+               .fillna(imputeVals))
+
+    return panelDf[list(metrics)], imputeVals[list(metrics)]
+
+
+def learnPanelTrends(panelDf,
+                     manualBoxCox=None,
+                     numFourierComponents=3,
+                     numSeasonalYears=1,
+                     globalTrendExponent=1.0):
+    r"""
+    DecomposedArima.learnTrendParams for every column of panelDf at once.
+
+    manualBoxCox maps metric to a manually set lambda.  Returns a dict
+    mapping metric to its trend parameters.
+    """
+
+    manualBoxCox = manualBoxCox or {}
+    metrics = list(panelDf.columns)
+
+    rollingDf = panelDf.rolling(7, center=True).mean().dropna()
+    Y = rollingDf.values
+
+    carryingCapacities = 2.2*Y.max(axis=0)
+
+    lambdas = _boxCoxNormMax(Y)
+    for i, metric in enumerate(metrics):
+        if metric in manualBoxCox:
+            lambdas[i] = manualBoxCox[metric]
+
+    negative = [m for m, l in zip(metrics, lambdas) if l < 0]
+    if negative:
+        raise RuntimeError('Box-Cox optimization found negative lambda for '
+                           '%s.  Please set manually.' % ', '.join(negative))
+
+    bcY = boxcox(Y, lambdas)
+
+    XPow = np.arange(0, Y.shape[0])**globalTrendExponent
+    slopes, intercepts, _ = fitGlobalTrends(bcY, globalTrendExponent)
+    detrendY = bcY - (slopes*XPow[:, None] + intercepts)
+
+    seasonalDf = learnSeasonalProfiles(
+        pd.DataFrame(detrendY, index=rollingDf.index, columns=metrics),
+        numFourierComponents=numFourierComponents,
+        numYears=numSeasonalYears
+    )
+
+    return {
+        metric: {
+            'boxCoxLambda': lambdas[i],
+            'manualBoxCox': metric in manualBoxCox,
+            'carryingCapacity': carryingCapacities[i],
+            'globalSlope': slopes[i],
+            'globalIntercept': intercepts[i],
+            'globalTrendExponent': globalTrendExponent,
+            'numFourierComponents': numFourierComponents,
+            'numSeasonalYears': numSeasonalYears,
+            'seasonalTrend': seasonalDf[metric]
+        }
+        for i, metric in enumerate(metrics)
+    }
+
+
+def summingMatrix(hierarchy):
+    r"""
+    Summing matrix of hierarchy, one row per metric and one column per bottom
+    level metric.  Row r has ones for the bottom level metrics that sum to r.
+    """
+
+    nodes, bottomNodes = _hierarchyNodes(hierarchy)
+
+    def leaves(node):
+        if node not in hierarchy:
+            return [node]
+        return [leaf for child in hierarchy[node] for leaf in leaves(child)]
+
+    S = pd.DataFrame(0, index=nodes, columns=bottomNodes)
+    for node in nodes:
+        S.loc[node, leaves(node)] = 1
+
+    return S
+
+
+def shrunkCovariance(resid):
+    r"""
+    Covariance of the (days x metrics) errors resid, shrunk towards its
+    diagonal as in Schafer and Strimmer (2005).  Used by MinT.
+    """
+
+    n = resid.shape[0]
+
+    covm = resid.T @ resid / n
+    std = np.sqrt(np.diag(covm))
+    target = np.diag(np.diag(covm))
+
+    xs = resid / std
+    v = (xs**2).T @ (xs**2) / (n*(n - 1)) - (xs.T @ xs)**2 / (n**2*(n - 1))
+    np.fill_diagonal(v, 0)
+
+    corm = covm / np.outer(std, std)
+    d = (corm - np.eye(len(std)))**2
+
+    shrinkage = min(max(v.sum() / d.sum(), 0), 1)
+
+    return shrinkage*target + (1 - shrinkage)*covm
+
+
+def _hierarchyNodes(hierarchy):
+    r"""
+    Every metric of hierarchy top down, and the bottom level metrics, both in
+    a stable order.
+    """
+
+    children = _childSet(hierarchy)
+    queue = [parent for parent in hierarchy if parent not in children]
+
+    nodes = []
+    while queue:
+        node = queue.pop(0)
+        if node in nodes:
+            raise RuntimeError('%s appears twice in the hierarchy.' % node)
+        nodes.append(node)
+        queue.extend(hierarchy.get(node, []))
+
+    bottomNodes = [node for node in nodes if node not in hierarchy]
+
+    return nodes, bottomNodes
+
+
+def _childSet(hierarchy):
+    return {child for children in hierarchy.values() for child in children}
+
+
+def _boxCoxNormMax(Y, numIter=60):
+    r"""
+    Box-Cox MLE lambda of every column of Y, by golden section search over
+    _BOX_COX_BOUNDS run on all columns at once.
+    """
+
+    logY = np.log(Y)
+    sumLogY = logY.sum(axis=0)
+    n = Y.shape[0]
+
+    def llf(lmbda):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bcY = np.where(lmbda == 0, logY, np.expm1(lmbda*logY) / lmbda)
+        return (lmbda - 1)*sumLogY - n/2*np.log(bcY.var(axis=0))
+
+    invPhi = (np.sqrt(5) - 1) / 2
+    lo = np.full(Y.shape[1], _BOX_COX_BOUNDS[0])
+    hi = np.full(Y.shape[1], _BOX_COX_BOUNDS[1])
+
+    a = hi - invPhi*(hi - lo)
+    b = lo + invPhi*(hi - lo)
+    llfA = llf(a)
+    llfB = llf(b)
+
+    for _ in range(numIter):
+        moveUp = llfA < llfB
+
+        lo = np.where(moveUp, a, lo)
+        hi = np.where(moveUp, hi, b)
+
+        newA = np.where(moveUp, b, hi - invPhi*(hi - lo))
+        newB = np.where(moveUp, lo + invPhi*(hi - lo), a)
+
+        # Only one of the two points is new for each column.
+        llfNew = llf(np.where(moveUp, newB, newA))
+        llfA, llfB = (np.where(moveUp, llfB, llfNew),
+                      np.where(moveUp, llfNew, llfA))
+        a, b = newA, newB
+
+    return (lo + hi) / 2
+
+
+def _setTrendParams(modelOb, params):
+    r""" Set trend parameters learned by learnPanelTrends on modelOb. """
+
+    for attr, val in params.items():
+        setattr(modelOb, attr, val)
+
+    modelOb.seasonalLookup = modelOb._buildSeasonalLookup(
+        modelOb.seasonalTrend)
+    modelOb.isTrendLearned = True
+    modelOb.trendLearnedThrough = modelOb.lastObservedDate
+
+
+def _predictModel(modelOb):
+    r""" Pool worker: fit modelOb and return its predictions. """
+
+    return modelOb.predict()
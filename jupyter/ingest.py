@@ -0,0 +1,294 @@
+import os
+import json
+import hashlib
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from instrumentation import getLogger
+
+logger = getLogger(__name__)
+
+
+r"""
+This module loads <metric>.csv files as daily or hourly averaged series.
+
+With a cachePath, the daily series is stored as Parquet (needs pyarrow) next
+to a small JSON manifest holding the size, mtime and sha256 of the source CSV.
+Later loads read the Parquet file instead of parsing the CSV, as long as the
+source is unchanged.
+
+With a chunkSize, the CSV is streamed in chunks of that many rows and only
+running per-day sums and counts are kept, so memory stays bounded by the
+number of days rather than the number of raw rows.
+
+Hourly series average the raw rows of each hour of each day instead, and are
+cached separately from the daily ones.
+"""
+
+CACHE_FORMAT_VERSION = 1
+
+# Resolution -> pandas frequency of its rows.
+resolutions = {'daily': 'D', 'hourly': 'h'}
+
+
+def loadDailySeries(dataPath, metric, cachePath=None, chunkSize=None):
+    r"""
+    Daily averages of metric and the mean of all raw values.
+
+    The mean is over the raw (intraday) rows, which is what BaseConfig uses to
+    impute missing days.  Returns (dailyDf, meanVal), where dailyDf has a
+    Date index and one column named metric.
+    """
+
+    return loadSeries(dataPath, metric, 'daily', cachePath, chunkSize)
+
+
+def loadHourlySeries(dataPath, metric, cachePath=None, chunkSize=None):
+    r"""
+    Hourly averages of metric and the mean of all raw values, like
+    loadDailySeries.  The Date index of hourlyDf holds the start of each hour.
+    """
+
+    return loadSeries(dataPath, metric, 'hourly', cachePath, chunkSize)
+
+
+def loadSeries(dataPath,
+               metric,
+               resolution='daily',
+               cachePath=None,
+               chunkSize=None):
+    r""" Averages of metric at resolution, one of resolutions. """
+
+    if resolution not in resolutions:
+        raise ValueError('Unknown resolution %s.' % resolution)
+
+    csvPath = '%s/%s.csv' % (dataPath, metric)
+
+    if cachePath is None:
+        return _readCsv(csvPath, metric, resolution, chunkSize)
+
+    # Daily entries keep their original names.
+    cacheName = metric if resolution == 'daily' else '%s.%s' % (metric,
+                                                                resolution)
+
+    manifestPath = os.path.join(cachePath, '%s.json' % cacheName)
+    stat = os.stat(csvPath)
+    manifest = _readManifest(manifestPath)
+
+    if manifest is not None:
+        if (manifest['size'] == stat.st_size
+                and manifest['mtimeNs'] == stat.st_mtime_ns):
+            return _readCached(cachePath, manifest)
+
+        # mtime changed, but the file may have only been touched or copied.
+        digest = _fileDigest(csvPath)
+        if manifest['sha256'] == digest:
+            manifest['size'] = stat.st_size
+            manifest['mtimeNs'] = stat.st_mtime_ns
+            _writeManifest(manifestPath, manifest)
+            return _readCached(cachePath, manifest)
+    else:
+        digest = _fileDigest(csvPath)
+
+    tsDf, meanVal = _readCsv(csvPath, metric, resolution, chunkSize)
+    _writeCache(cachePath, cacheName, metric, tsDf, meanVal, digest, stat,
+                manifest)
+
+    return tsDf, meanVal
+
+
+def warmIngestCache(dataPath,
+                    cachePath,
+                    metrics=None,
+                    numWorkers=None,
+                    chunkSize=None,
+                    resolution='daily'):
+    r"""
+    Build or refresh the cache for every metric under dataPath.
+
+    Returns a dict mapping metric to the error message for metrics that could
+    not be loaded.
+    """
+
+    if metrics is None:
+        metrics = sorted(os.path.splitext(f)[0]
+                         for f in os.listdir(dataPath) if f.endswith('.csv'))
+
+    # Imported here, batch_runner imports this module through shared_store.
+    from batch_runner import singleThreadedBlas
+
+    failures = {}
+    ctx = mp.get_context('spawn')
+    with singleThreadedBlas():
+        with ProcessPoolExecutor(max_workers=numWorkers,
+                                 mp_context=ctx) as pool:
+            futures = {metric: pool.submit(loadSeries,
+                                           dataPath,
+                                           metric,
+                                           resolution,
+                                           cachePath,
+                                           chunkSize)
+                       for metric in metrics}
+
+            for metric, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    failures[metric] = repr(e)
+
+    logger.info('Warmed ingest cache for %d of %d metrics.'
+                % (len(metrics) - len(failures), len(metrics)))
+
+    return failures
+
+
+def _readCsv(csvPath, metric, resolution='daily', chunkSize=None):
+    r""" Parse the raw csv and average it to values at resolution. """
+
+    if chunkSize is not None:
+        return _readCsvChunked(csvPath, metric, resolution, chunkSize)
+
+    df = pd.read_csv(csvPath)
+
+    # V1 - only look at averages.
+    tsDf = (df[metric]
+            .groupby(_periodStarts(df, resolution))
+            .mean()
+            .dropna()  # ???
+            .to_frame(metric))
+
+    meanVal = df[metric].dropna().mean()
+
+    return tsDf, meanVal
+
+
+def _readCsvChunked(csvPath, metric, resolution, chunkSize):
+    r"""
+    Same output as _readCsv, streaming the csv chunkSize rows at a time.
+    """
+
+    periodTotals = None
+    rawSum = 0.0
+    rawCount = 0
+
+    usecols = ['Date', metric]
+    if resolution != 'daily':
+        usecols.append('Time')
+
+    chunks = pd.read_csv(csvPath,
+                         usecols=usecols,
+                         chunksize=chunkSize)
+
+    for chunk in chunks:
+        # Count only non-null values, like mean() does.
+        chunkTotals = (chunk[metric]
+                       .groupby(_periodStarts(chunk, resolution))
+                       .agg(['sum', 'count']))
+
+        if periodTotals is None:
+            periodTotals = chunkTotals
+        else:
+            periodTotals = periodTotals.add(chunkTotals, fill_value=0)
+
+        rawSum += chunk[metric].sum()
+        rawCount += chunk[metric].count()
+
+    periodTotals = periodTotals[periodTotals['count'] > 0]
+
+    tsDf = pd.DataFrame(
+        {metric: periodTotals['sum'] / periodTotals['count']},
+        index=periodTotals.index
+    )
+
+    return tsDf, rawSum / rawCount
+
+
+def _periodStarts(df, resolution):
+    r""" Start of the period at resolution of every raw row, named Date. """
+
+    dates = pd.to_datetime(df['Date'])
+
+    if resolution == 'daily':
+        return dates
+
+    times = pd.to_timedelta(df['Time'])
+
+    return (dates + times).dt.floor(resolutions[resolution]).rename('Date')
+
+
+def _fileDigest(path, blockSize=1 << 20):
+    r""" sha256 of a file, read in blocks. """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(blockSize), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def _readManifest(manifestPath):
+    r""" The manifest dict, or None if missing or from another format. """
+
+    try:
+        with open(manifestPath) as fh:
+            manifest = json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get('formatVersion') != CACHE_FORMAT_VERSION:
+        return None
+
+    return manifest
+
+
+def _writeManifest(manifestPath, manifest):
+    r""" Write the manifest atomically, so concurrent loads never see half. """
+
+    tmpPath = '%s.%d.tmp' % (manifestPath, os.getpid())
+    with open(tmpPath, 'w') as fh:
+        json.dump(manifest, fh)
+    os.replace(tmpPath, manifestPath)
+
+
+def _readCached(cachePath, manifest):
+    tsDf = pd.read_parquet(os.path.join(cachePath, manifest['parquet']))
+
+    return tsDf, manifest['meanVal']
+
+
+def _writeCache(cachePath,
+                cacheName,
+                metric,
+                tsDf,
+                meanVal,
+                digest,
+                stat,
+                oldManifest):
+    os.makedirs(cachePath, exist_ok=True)
+
+    parquetName = '%s.%s.parquet' % (cacheName, digest[:16])
+    parquetPath = os.path.join(cachePath, parquetName)
+
+    tmpPath = '%s.%d.tmp' % (parquetPath, os.getpid())
+    tsDf.to_parquet(tmpPath)
+    os.replace(tmpPath, parquetPath)
+
+    _writeManifest(os.path.join(cachePath, '%s.json' % cacheName), {
+        'formatVersion': CACHE_FORMAT_VERSION,
+        'metric': metric,
+        'size': stat.st_size,
+        'mtimeNs': stat.st_mtime_ns,
+        'sha256': digest,
+        'meanVal': float(meanVal),
+        'parquet': parquetName
+    })
+
+    # Drop the stale Parquet file from the previous version of the csv.
+    if oldManifest is not None and oldManifest['parquet'] != parquetName:
+        try:
+            os.remove(os.path.join(cachePath, oldManifest['parquet']))
+        except OSError:
+            pass
@@ -0,0 +1,191 @@
+import sys
+import json
+import time
+import logging
+import functools
+import contextvars
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+r"""
+This module holds the logging and timing instrumentation for the pipeline.
+
+Pipeline steps are wrapped in named spans.  Spans are only recorded inside a
+recording() block, which collects wall time, CPU time and peak RSS growth of
+every span into a SpanRecorder:
+
+    with recording(metric='MaxConcurrentStreamsOverall') as rec:
+        generateDeliverable(modelOb)
+    rec.toJson('spans.json')
+
+Outside recording() spans cost next to nothing.
+"""
+
+_currentRecorder = contextvars.ContextVar('currentRecorder', default=None)
+
+
+def getLogger(name):
+    r""" Logger for a pipeline module, configured with configureLogging. """
+
+    return logging.getLogger('forecast.%s' % name)
+
+
+def configureLogging(level=logging.INFO, stream=None):
+    r"""
+    Send pipeline progress messages to stream (default stdout) at level.
+
+    Replaces the print() output the pipeline used to have.
+    """
+
+    logger = logging.getLogger('forecast')
+    logger.setLevel(level)
+
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(name)s %(levelname)s: %(message)s'))
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    return logger
+
+
+class SpanRecorder:
+    r"""
+    Collects the spans finished inside a recording() block.
+
+    tags (e.g. runId, metric) are attached to every exported row.
+    """
+
+    def __init__(self, **tags):
+        self.tags = tags
+        self.spans = []
+        self._stack = []
+
+    def toFrame(self):
+        r""" One row per span, in the order the spans finished. """
+
+        columns = ['name', 'path', 'depth', 'wallSeconds', 'cpuSeconds',
+                   'peakRssDeltaMB']
+        df = pd.DataFrame(self.spans, columns=columns)
+        for key, val in self.tags.items():
+            df[key] = val
+
+        return df
+
+    def toJson(self, path):
+        with open(path, 'w') as fh:
+            json.dump({'tags': self.tags, 'spans': self.spans},
+                      fh,
+                      default=str,
+                      indent=2)
+
+    def toCsv(self, path):
+        self.toFrame().to_csv(path, index=False)
+
+
+@contextmanager
+def recording(**tags):
+    r""" Record every span finished inside this block.  Yields recorder. """
+
+    recorder = SpanRecorder(**tags)
+    token = _currentRecorder.set(recorder)
+
+    try:
+        yield recorder
+    finally:
+        _currentRecorder.reset(token)
+
+
+@contextmanager
+def span(name):
+    r""" Time the enclosed block as a span called name. """
+
+    recorder = _currentRecorder.get()
+
+    if recorder is None:
+        yield
+        return
+
+    recorder._stack.append(name)
+    startRss = _peakRssMB()
+    startCpu = time.process_time()
+    startWall = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - startWall
+        cpu = time.process_time() - startCpu
+        rssDelta = _peakRssMB() - startRss
+
+        recorder.spans.append({
+            'name': name,
+            'path': '/'.join(recorder._stack),
+            'depth': len(recorder._stack) - 1,
+            'wallSeconds': wall,
+            'cpuSeconds': cpu,
+            'peakRssDeltaMB': rssDelta
+        })
+        recorder._stack.pop()
+
+
+def timed(name=None):
+    r""" Decorator wrapping every call of a function in a span. """
+
+    def decorator(func):
+        spanName = func.__name__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(spanName):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def aggregateSpans(frames):
+    r"""
+    Summarize spans from many recorders (e.g. one per metric of a batch).
+
+    frames are SpanRecorder.toFrame() outputs.  Returns one row per span path
+    with call counts and total, mean and max times.
+    """
+
+    df = pd.concat(list(frames), ignore_index=True)
+
+    return (df
+            .groupby('path')
+            .agg(calls=('wallSeconds', 'size'),
+                 totalWallSeconds=('wallSeconds', 'sum'),
+                 meanWallSeconds=('wallSeconds', 'mean'),
+                 maxWallSeconds=('wallSeconds', 'max'),
+                 totalCpuSeconds=('cpuSeconds', 'sum'),
+                 maxPeakRssDeltaMB=('peakRssDeltaMB', 'max'))
+            .sort_values('totalWallSeconds', ascending=False))
+
+
+def _peakRssMB():
+    r""" Peak resident set size of this process so far, in MB. """
+
+    if resource is None:
+        return float('nan')
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, macOS bytes.
+    if sys.platform == 'darwin':
+        return peak / 2**20
+
+    return peak / 2**10
@@ -0,0 +1,538 @@
+import numpy as np
+from scipy.signal import lfilter
+from scipy.linalg import solve_discrete_lyapunov
+
+from instrumentation import getLogger
+
+logger = getLogger(__name__)
+
+
+r"""
+This module fits seasonal ARIMA models with at most one coefficient per
+polynomial, like the default SARIMA(1,0,1)(1,1,1,7) of DecomposedArima, in
+plain NumPy.
+
+The series is differenced, and the exact Gaussian likelihood of the
+differenced series is maximized with analytic gradients.  Instead of running
+a Kalman filter step by step, the likelihood integrates the presample values
+out of the residual recursion:
+
+    residuals = u + G z,    z ~ N(0, Omega)
+
+where u and the columns of G are whole-series linear filters and Omega is
+the stationary covariance of the presample z.  This is the same likelihood
+the Kalman filter computes (and statsmodels with exactly diffuse
+differencing), but every step is vectorized over time.  The Kalman filter
+only runs once, with the fitted parameters, for the in-sample predictions
+and the state forecasts start from.
+
+SeasonalArima has the part of the pmdarima ARIMA interface DecomposedArima
+uses, so it can stand in for it (DecomposedArima.arimaEngine = 'numpy').
+"""
+
+
+def isSupportedOrder(order, seasonal_order):
+    r""" Whether SeasonalArima can fit SARIMA order x seasonal_order. """
+
+    p, d, q = order
+    P, D, Q, s = seasonal_order
+
+    if max(p, q, P, Q) > 1 or min(p, d, q, P, D, Q) < 0:
+        return False
+
+    return not ((P or D or Q) and s < 2)
+
+
+class SeasonalArima:
+    r"""
+    SARIMA(p,d,q)(P,D,Q,s) with p, q, P and Q at most 1, without intercept.
+
+    params are ordered like statsmodels': ar.L1, ma.L1, ar.S.Ls, ma.S.Ls
+    (the ones in the model) and sigma2.
+    """
+
+    def __init__(self, order=(1, 0, 1), seasonal_order=(1, 1, 1, 7),
+                 maxiter=50):
+        p, d, q = order
+        P, D, Q, s = seasonal_order
+
+        if max(p, q, P, Q) > 1 or min(p, d, q, P, D, Q) < 0:
+            raise ValueError('SeasonalArima supports p, q, P and Q of at '
+                             'most 1, got %s%s.' % (order, seasonal_order))
+
+        if not isSupportedOrder(order, seasonal_order):
+            raise ValueError('Seasonal period must be at least 2.')
+
+        self.order = tuple(order)
+        self.seasonal_order = tuple(seasonal_order)
+        self.maxiter = maxiter
+
+        # Names of the polynomial coefficients in the model, in params order.
+        self.paramNames = ([name for name, k in [('ar.L1', p),
+                                                 ('ma.L1', q),
+                                                 ('ar.S.L%d' % s, P),
+                                                 ('ma.S.L%d' % s, Q)] if k]
+                           + ['sigma2'])
+
+        # The differencing polynomial (1 - B)^d (1 - B^s)^D.
+        self.diffPoly = np.array([1.])
+        for _ in range(d):
+            self.diffPoly = np.convolve(self.diffPoly, [1., -1.])
+        for _ in range(D):
+            self.diffPoly = np.convolve(self.diffPoly,
+                                        np.r_[1., np.zeros(s - 1), -1.])
+
+        self.endog = None
+        self.params = None
+        self.llf = None
+        self.converged = None
+        self.numIterations = None
+
+    @property
+    def numDiff(self):
+        r""" Observations lost to differencing. """
+
+        return len(self.diffPoly) - 1
+
+    ############################################
+    # Part of the pmdarima ARIMA interface.
+    ############################################
+
+    def fit(self, y):
+        r""" Fit by exact maximum likelihood.  Returns self. """
+
+        self.endog = _asEndog(y)
+        self.params = None
+
+        return self._fit(np.zeros(len(self.paramNames) - 1), self.maxiter)
+
+    def update(self, y, maxiter=None):
+        r"""
+        Append new observations and refit from the current parameters with
+        at most maxiter iterations.
+        """
+
+        self.endog = np.concatenate([self.endog, _asEndog(y)])
+
+        return self._fit(_unconstrain(self.params[:-1]),
+                         self.maxiter if maxiter is None else maxiter)
+
+    def predict(self, n_periods=10, return_conf_int=False, alpha=0.05):
+        r""" Forecasts n_periods past the data, and (lower, upper) columns. """
+
+        from scipy.special import ndtri
+
+        mean, var = self._forecast(n_periods)
+
+        if not return_conf_int:
+            return mean
+
+        halfWidth = ndtri(1 - alpha/2) * np.sqrt(var)
+
+        return mean, np.column_stack([mean - halfWidth, mean + halfWidth])
+
+    def predict_in_sample(self):
+        r"""
+        One step ahead predictions of the data.  The first numDiff are zero,
+        as nothing is known before them.
+        """
+
+        preds = np.zeros(len(self.endog))
+        # The differencing is known from earlier observations.
+        preds[self.numDiff:] = (self._filtered['preds']
+                                + self.endog[self.numDiff:]
+                                - self._diffed)
+
+        return preds
+
+    def aic(self):
+        return -2*self.llf + 2*len(self.params)
+
+    def summary(self):
+        r""" Text summary of the fit. """
+
+        lines = ['SeasonalArima%s%s' % (self.order, self.seasonal_order),
+                 'Observations: %d' % len(self.endog),
+                 'Log likelihood: %.3f' % self.llf,
+                 'AIC: %.3f' % self.aic()]
+
+        if self.converged is not None:
+            lines.append('Converged: %s after %d iterations'
+                         % (self.converged, self.numIterations))
+
+        lines.extend('%-10s %12.6f' % (name, val)
+                     for name, val in zip(self.paramNames, self.params))
+
+        return '\n'.join(lines)
+
+    ############################################
+    # Filtering and forecasting.
+    ############################################
+
+    def filter(self, y, params):
+        r""" Filter y with fixed params, no fitting.  Returns self. """
+
+        self.endog = _asEndog(y)
+        self.params = np.asarray(params, dtype=float)
+        self.converged = None
+        self.numIterations = None
+        self._runFilter()
+
+        return self
+
+    def append(self, y):
+        r""" Filter new observations with the current params. """
+
+        return self.filter(np.concatenate([self.endog, _asEndog(y)]),
+                           self.params)
+
+    def stateSpace(self):
+        r"""
+        The forecasting state space model, for simulation: design,
+        transition, selection, stateCov and obsCov matrices, and the state
+        and its covariance predicted for the step after the data.
+
+        The state is the ARMA state of the differenced series followed by
+        the last numDiff observations, newest first.
+        """
+
+        arPoly, maPoly = _polynomials(self._coefs(), self._spec())[:2]
+        T, R = _harveyMatrices(arPoly, maPoly)
+        m = len(T)
+        k = m + self.numDiff
+        sigma2 = self.params[-1]
+
+        design = np.zeros((1, k))
+        design[0, 0] = 1
+        design[0, m:] = -self.diffPoly[1:]
+
+        transition = np.zeros((k, k))
+        transition[:m, :m] = T
+        if self.numDiff:
+            transition[m] = design[0]
+            transition[m + 1:, m:-1] = np.eye(self.numDiff - 1)
+
+        selection = np.zeros((k, 1))
+        selection[:m, 0] = R
+
+        state = np.concatenate([self._filtered['state'],
+                                self.endog[::-1][:self.numDiff]])
+        stateCov = np.zeros((k, k))
+        stateCov[:m, :m] = sigma2 * self._filtered['stateCov']
+
+        return {'design': design,
+                'transition': transition,
+                'selection': selection,
+                'stateCov': np.array([[sigma2]]),
+                'obsCov': np.zeros((1, 1)),
+                'predictedState': state,
+                'predictedStateCov': stateCov}
+
+    def _forecast(self, numSteps):
+        r""" Mean and variance of the next numSteps observations. """
+
+        ss = self.stateSpace()
+        Z = ss['design'][0]
+        T = ss['transition']
+        RQR = ss['selection'] @ ss['stateCov'] @ ss['selection'].T
+
+        state = ss['predictedState']
+        stateCov = ss['predictedStateCov']
+
+        mean = np.empty(numSteps)
+        var = np.empty(numSteps)
+        for h in range(numSteps):
+            mean[h] = Z @ state
+            var[h] = Z @ stateCov @ Z
+
+            state = T @ state
+            stateCov = T @ stateCov @ T.T + RQR
+
+        return mean, var
+
+    def _fit(self, start, maxiter):
+        from scipy.optimize import minimize
+
+        w = self._difference(self.endog)
+        spec = self._spec()
+
+        if len(start) == 0 or maxiter == 0:
+            x = start
+            self.converged, self.numIterations = True, 0
+        else:
+            res = minimize(_negLogLike,
+                           start,
+                           args=(w, spec),
+                           jac=True,
+                           method='L-BFGS-B',
+                           options={'maxiter': maxiter})
+            x = res.x
+            self.converged, self.numIterations = res.success, res.nit
+
+            if not res.success:
+                logger.warning('ARIMA likelihood optimization did not '
+                               'converge: %s' % res.message)
+
+        # sigma2 is concentrated out of the likelihood, the filter gives it.
+        self.params = np.r_[_constrain(x), np.nan]
+        self._runFilter(estimateScale=True)
+
+        return self
+
+    def _runFilter(self, estimateScale=False):
+        self._diffed = self._difference(self.endog)
+
+        arPoly, maPoly = _polynomials(self._coefs(), self._spec())[:2]
+        self._filtered = _kalmanFilter(self._diffed, arPoly, maPoly)
+
+        v = self._filtered['residuals']
+        F = self._filtered['variances']
+        if estimateScale:
+            self.params[-1] = np.mean(v**2 / F)
+
+        sigma2 = self.params[-1]
+        self.llf = -0.5*np.sum(np.log(2*np.pi*sigma2*F) + v**2/(sigma2*F))
+
+    def _difference(self, y):
+        if len(y) <= self.numDiff:
+            raise ValueError('Need more than %d observations.' % self.numDiff)
+
+        return lfilter(self.diffPoly, [1.], y)[self.numDiff:]
+
+    def _coefs(self):
+        return self.params[:-1]
+
+    def _spec(self):
+        p, _, q = self.order
+        P, _, Q, s = self.seasonal_order
+
+        return p, q, P, Q, s
+
+
+def _asEndog(y):
+    y = np.asarray(y, dtype=float).ravel()
+
+    if np.isnan(y).any():
+        # DecomposedArima gets these with less than two years of data, where
+        # the seasonal profile doesn't cover every day.
+        raise ValueError('SeasonalArima can not handle missing values, '
+                         'fit with pmdarima instead.')
+
+    return y
+
+
+def _constrain(x):
+    r""" Map unconstrained values into (-1, 1), keeping roots outside. """
+
+    return x / np.sqrt(1 + x**2)
+
+
+def _unconstrain(c):
+    return c / np.sqrt(1 - c**2)
+
+
+def _polynomials(coefs, spec):
+    r"""
+    AR and MA lag polynomials of the differenced series, as coefficient
+    arrays starting at lag 0, and their derivatives by each coefficient.
+    """
+
+    p, q, P, Q, s = spec
+    coefs = list(coefs)
+
+    phi = coefs.pop(0) if p else None
+    theta = coefs.pop(0) if q else None
+    sPhi = coefs.pop(0) if P else None
+    sTheta = coefs.pop(0) if Q else None
+
+    lag1 = np.array([0., 1.])
+    lagS = np.r_[np.zeros(s), 1.] if (P or Q) else None
+
+    nsAr = np.array([1., -phi]) if p else np.array([1.])
+    sAr = np.r_[1., np.zeros(s - 1), -sPhi] if P else np.array([1.])
+    nsMa = np.array([1., theta]) if q else np.array([1.])
+    sMa = np.r_[1., np.zeros(s - 1), sTheta] if Q else np.array([1.])
+
+    arPoly = np.convolve(nsAr, sAr)
+    maPoly = np.convolve(nsMa, sMa)
+
+    dAr = []
+    dMa = []
+    if p:
+        dAr.append(np.convolve(-lag1, sAr))
+        dMa.append(np.zeros(len(maPoly)))
+    if q:
+        dAr.append(np.zeros(len(arPoly)))
+        dMa.append(np.convolve(lag1, sMa))
+    if P:
+        dAr.append(np.convolve(nsAr, -lagS))
+        dMa.append(np.zeros(len(maPoly)))
+    if Q:
+        dAr.append(np.zeros(len(arPoly)))
+        dMa.append(np.convolve(nsMa, lagS))
+
+    return (arPoly,
+            maPoly,
+            np.array(dAr).reshape(-1, len(arPoly)),
+            np.array(dMa).reshape(-1, len(maPoly)))
+
+
+def _presampleInputs(arPoly, maPoly, n):
+    r"""
+    (n x numPresample) inputs of the residual recursion from each presample
+    value: w_0, w_-1, ... then e_0, e_-1, ...
+    """
+
+    numAr = len(arPoly) - 1
+    numMa = len(maPoly) - 1
+
+    X = np.zeros((n, numAr + numMa))
+    for k in range(1, numAr + 1):
+        X[:numAr - k + 1, k - 1] = arPoly[k:]
+    for k in range(1, numMa + 1):
+        X[:numMa - k + 1, numAr + k - 1] = -maPoly[k:]
+
+    return X
+
+
+def _presampleTransition(arPoly, maPoly):
+    r"""
+    Transition and shock loading of the presample vector, so its stationary
+    covariance Omega solves Omega = A Omega A' + c c'.
+    """
+
+    numAr = len(arPoly) - 1
+    numMa = len(maPoly) - 1
+    k = numAr + numMa
+
+    A = np.zeros((k, k))
+    c = np.zeros(k)
+
+    if numAr:
+        A[0, :numAr] = -arPoly[1:]
+        A[0, numAr:] = maPoly[1:]
+        A[1:numAr, :numAr - 1] = np.eye(numAr - 1)
+        c[0] = 1
+    if numMa:
+        A[numAr + 1:, numAr:-1] = np.eye(numMa - 1)
+        c[numAr] = 1
+
+    return A, c
+
+
+def _negLogLike(x, w, spec):
+    r"""
+    Exact Gaussian negative log likelihood per observation of the
+    differenced series w, with sigma2 concentrated out, and its gradient
+    by the unconstrained parameters x.
+    """
+
+    n = len(w)
+    coefs = _constrain(x)
+    arPoly, maPoly, dAr, dMa = _polynomials(coefs, spec)
+    numParams = len(x)
+
+    # Residuals with a zero presample, and their derivatives.
+    u = lfilter(arPoly, maPoly, w)
+    du = np.array([lfilter(dAr[i], maPoly, w) - lfilter(dMa[i], maPoly, u)
+                   for i in range(numParams)]).reshape(numParams, n)
+
+    # Effect of every presample value on the residuals, and its derivatives.
+    X = _presampleInputs(arPoly, maPoly, n)
+    G = lfilter([1.], maPoly, X, axis=0)
+
+    dX = np.stack([_presampleInputs(dAr[i], dMa[i], n)
+                   for i in range(numParams)], axis=1)
+    dMaG = np.stack([lfilter(dMa[i], [1.], G, axis=0)
+                     for i in range(numParams)], axis=1)
+    dG = lfilter([1.], maPoly, dX - dMaG, axis=0)
+
+    # Stationary covariance of the presample, and its derivatives.
+    A, c = _presampleTransition(arPoly, maPoly)
+    k = len(A)
+    if k:
+        Omega = solve_discrete_lyapunov(A, np.outer(c, c))
+        dOmega = []
+        for i in range(numParams):
+            # A is affine in the polynomials, so this is its derivative.
+            dA = _presampleTransition(arPoly + dAr[i], maPoly + dMa[i])[0] - A
+            M = dA @ Omega @ A.T
+            dOmega.append(solve_discrete_lyapunov(A, M + M.T))
+        dOmega = np.array(dOmega).reshape(numParams, k, k)
+    else:
+        Omega = np.zeros((0, 0))
+        dOmega = np.zeros((numParams, 0, 0))
+
+    C = G.T @ G
+    g = G.T @ u
+    Minv = np.linalg.inv(np.eye(k) + C @ Omega)
+    r = Minv @ g
+    q = Omega @ r
+
+    S = u @ u - g @ q
+    logDet = np.linalg.slogdet(np.eye(k) + C @ Omega)[1]
+
+    # Derivatives of S and logDet by each coefficient.
+    dC = np.einsum('tip,tq->ipq', dG, G)
+    dC = dC + dC.transpose(0, 2, 1)
+    dg = np.einsum('tip,t->ip', dG, u) + du @ G
+
+    dS = (2*du @ u
+          - 2*dg @ q
+          + np.einsum('p,ipq,q->i', q, dC, q)
+          - np.einsum('p,ipq,q->i', r, dOmega, r))
+    dLogDet = (np.einsum('pq,iqr,rp->i', Minv, dC, Omega)
+               + np.einsum('pq,qr,irp->i', Minv, C, dOmega))
+
+    negLogLike = 0.5*(np.log(2*np.pi) + 1 + np.log(S/n) + logDet/n)
+    grad = 0.5*(dS/S + dLogDet/n)
+
+    return negLogLike, grad * (1 + x**2)**-1.5
+
+
+def _harveyMatrices(arPoly, maPoly):
+    r""" Transition and selection of the ARMA state space in Harvey form. """
+
+    m = max(len(arPoly) - 1, len(maPoly))
+
+    T = np.zeros((m, m))
+    T[:len(arPoly) - 1, 0] = -arPoly[1:]
+    T[:-1, 1:] = np.eye(m - 1)
+
+    R = np.zeros(m)
+    R[:len(maPoly)] = maPoly
+
+    return T, R
+
+
+def _kalmanFilter(w, arPoly, maPoly):
+    r"""
+    Kalman filter of the differenced series w with unit shock variance,
+    started from the stationary distribution.  Returns the one step
+    predictions, residuals and their variances, and the state and its
+    covariance predicted for the step after w.
+    """
+
+    T, R = _harveyMatrices(arPoly, maPoly)
+    RR = np.outer(R, R)
+
+    state = np.zeros(len(T))
+    stateCov = solve_discrete_lyapunov(T, RR)
+
+    n = len(w)
+    preds = np.empty(n)
+    variances = np.empty(n)
+    for t in range(n):
+        preds[t] = state[0]
+        F = stateCov[0, 0]
+        variances[t] = F
+
+        gain = T @ stateCov[:, 0] / F
+        state = T @ state + gain*(w[t] - preds[t])
+        stateCov = T @ stateCov @ T.T + RR - F*np.outer(gain, gain)
+
+    return {'preds': preds,
+            'residuals': w - preds,
+            'variances': variances,
+            'state': state,
+            'stateCov': stateCov}
@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+
+
+r"""
+This module learns the Fourier seasonal profiles of many series at once.
+
+The series are the columns of a daily frame.  Each full calendar year of it is
+transformed with one FFT along the time axis, the spectra of the last few
+years are averaged, and the top few low frequency coefficients of every
+series are kept.  DecomposedArima.learnSeasonalTrend is the one-column case.
+
+Hourly series also get a profile over the 168 hours of the week, learned the
+same way from their last few full weeks.  Its frequencies are cycles per
+week, so bin 7 is the daily cycle and bins 14, 21, ... its harmonics, and one
+small set of coefficients carries both the daily and the weekly seasonality.
+"""
+
+HOURS_PER_WEEK = 168
+
+
+def learnSeasonalProfiles(tsDf,
+                          numFourierComponents=3,
+                          numYears=1,
+                          maxFrequency=12):
+    r"""
+    Seasonal profile of every column of tsDf, learned from full years.
+
+    The profiles are learned from the numYears calendar years before the
+    year of the last non-null row, skipping earlier years that are not fully
+    covered, and laid out on the dates of the latest of those years.  Returns
+    a frame with those dates and tsDf's columns.
+    """
+
+    if isinstance(tsDf, pd.Series):
+        return learnSeasonalProfiles(tsDf.to_frame(),
+                                     numFourierComponents,
+                                     numYears,
+                                     maxFrequency).iloc[:, 0]
+
+    lastYear = tsDf.dropna(how='all').index.max().year - 1
+
+    templateData = tsDf.loc[str(lastYear)]
+    templateLength = len(templateData)
+
+    # Scale every year's spectrum to the template year's length, so that bin j
+    # is j cycles per year in all of them.  The template itself is multiplied
+    # by exactly 1, which keeps numYears=1 identical to a single FFT.
+    spectrum = np.zeros((tsDf.shape[1], templateLength), dtype=complex)
+    yearsUsed = 0
+    for year in range(lastYear - numYears + 1, lastYear + 1):
+        yearData = tsDf[tsDf.index.year == year].values.T
+
+        if year != lastYear and yearData.shape[1] < 365:
+            continue
+
+        Z = np.fft.fft(yearData, axis=1)
+
+        n = min(templateLength, Z.shape[1])
+        spectrum[:, :n] += Z[:, :n] * (templateLength / Z.shape[1])
+        yearsUsed += 1
+
+    if yearsUsed > 1:
+        spectrum /= yearsUsed
+
+    filtered = filterSpectra(spectrum, numFourierComponents, maxFrequency)
+    profiles = np.fft.ifft(filtered, axis=1).real
+
+    return pd.DataFrame(profiles.T,
+                        index=templateData.index,
+                        columns=tsDf.columns)
+
+
+def learnWeeklyProfiles(tsDf,
+                        numFourierComponents=6,
+                        numWeeks=8,
+                        maxFrequency=28):
+    r"""
+    Hour of week profile of every column of the gapless hourly frame tsDf.
+
+    The profiles are learned from the last numWeeks full weeks (Monday
+    00:00 to Sunday 23:00) of tsDf.  Returns a frame indexed by HourOfWeek,
+    0 being Monday 00:00, with tsDf's columns.
+    """
+
+    if isinstance(tsDf, pd.Series):
+        return learnWeeklyProfiles(tsDf.to_frame(),
+                                   numFourierComponents,
+                                   numWeeks,
+                                   maxFrequency).iloc[:, 0]
+
+    weekEnds = np.flatnonzero(hourOfWeek(tsDf.index) == HOURS_PER_WEEK - 1)
+    stop = weekEnds[-1] + 1 if len(weekEnds) else 0
+    numWeeks = min(numWeeks, stop // HOURS_PER_WEEK)
+
+    if numWeeks == 0:
+        raise ValueError('Need at least one full week of hourly data.')
+
+    weeks = tsDf.values[stop - numWeeks*HOURS_PER_WEEK:stop].reshape(
+        numWeeks, HOURS_PER_WEEK, tsDf.shape[1])
+
+    # The FFT is linear, so the spectrum of the mean week is the mean of the
+    # weekly spectra.  rfft keeps the non-negative frequencies, and irfft
+    # restores their conjugates.
+    Z = np.fft.rfft(np.nanmean(weeks, axis=0).T, axis=1)
+    filtered = filterSpectra(Z, numFourierComponents, maxFrequency)
+    profiles = np.fft.irfft(filtered, n=HOURS_PER_WEEK, axis=1)
+
+    return pd.DataFrame(profiles.T,
+                        index=pd.RangeIndex(HOURS_PER_WEEK, name='HourOfWeek'),
+                        columns=tsDf.columns)
+
+
+def hourOfWeek(idx):
+    r""" Position of each hour of idx in a learnWeeklyProfiles profile. """
+
+    return idx.dayofweek.values * 24 + idx.hour.values
+
+
+def filterSpectra(Z, numFourierComponents=3, maxFrequency=12):
+    r"""
+    Keep the numFourierComponents largest coefficients of each row of Z among
+    frequencies 0 to maxFrequency, and zero everything else.
+
+    Higher frequencies are dropped so the weekly seasonality can't dominate.
+    """
+
+    filtered = np.zeros_like(Z)
+
+    if numFourierComponents == 0:
+        return filtered
+
+    lowFreq = Z[:, :maxFrequency+1]
+    k = min(numFourierComponents, lowFreq.shape[1])
+
+    top = np.argpartition(-np.abs(lowFreq), k - 1, axis=1)[:, :k]
+    np.put_along_axis(filtered,
+                      top,
+                      np.take_along_axis(lowFreq, top, axis=1),
+                      axis=1)
+
+    return filtered
@@ -0,0 +1,372 @@
+import os
+import re
+import sys
+import copy
+import json
+import time
+import asyncio
+import argparse
+import threading
+import multiprocessing as mp
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import pandas as pd
+
+from instrumentation import getLogger, configureLogging
+
+logger = getLogger(__name__)
+
+
+r"""
+This module serves forecasts from saved DecomposedArima models over HTTP.
+
+Models are saved as <modelPath>/<metric>.model (see DecomposedArima.save) and
+loaded on first use, keeping at most maxModels of them resident.  Routes:
+
+    GET  /forecast?metric=<metric>&horizon=<days>[&alpha=<alpha>]
+    POST /refit?metric=<metric>
+    GET  /health
+
+Metric names become file names, so they may only hold letters, digits, '_',
+'-' and '.', and horizons are capped at maxHorizon days.
+
+Forecasts are computed on a thread pool from the stored fit.  Refits read
+<dataPath>/<metric>.csv, fit and save on a process pool, so the event loop
+never blocks on either.  Run from this directory:
+
+    python service.py --model-path ./models --data-path ./data --port 8080
+"""
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+            405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+_METRIC_PATTERN = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+
+def isValidMetric(metric):
+    r""" Whether metric is safe to join into model and data paths. """
+
+    return (_METRIC_PATTERN.match(metric) is not None
+            and metric not in ('.', '..'))
+
+
+class ModelStore:
+    r"""
+    Saved models loaded on demand, least recently used evicted first.
+    """
+
+    def __init__(self, modelPath, maxModels=32, executor=None):
+        self.modelPath = modelPath
+        self.maxModels = maxModels
+        self.executor = executor
+        self._models = OrderedDict()
+        # Loads in flight, so concurrent requests share one load.
+        self._loading = {}
+        # One lock per metric.  A fit's statsmodels results are not thread
+        # safe, so forecasts from the same model run one at a time.
+        self._locks = {}
+
+    def modelFilePath(self, metric):
+        if not isValidMetric(metric):
+            raise ValueError('Invalid metric name %r.' % metric)
+
+        return os.path.join(self.modelPath, '%s.model' % metric)
+
+    async def get(self, metric):
+        r""" The model for metric.  Raises KeyError if none is saved. """
+
+        if metric in self._models:
+            self._models.move_to_end(metric)
+            return self._models[metric]
+
+        if metric not in self._loading:
+            path = self.modelFilePath(metric)
+            if not os.path.exists(path):
+                raise KeyError(metric)
+
+            loop = asyncio.get_running_loop()
+            self._loading[metric] = loop.run_in_executor(self.executor,
+                                                         _loadModel,
+                                                         path)
+
+        try:
+            modelOb = await self._loading[metric]
+        finally:
+            self._loading.pop(metric, None)
+
+        self._models[metric] = modelOb
+        self._models.move_to_end(metric)
+        while len(self._models) > self.maxModels:
+            evicted, _ = self._models.popitem(last=False)
+            logger.info('Evicted model %s.' % evicted)
+
+        return modelOb
+
+    def lock(self, metric):
+        return self._locks.setdefault(metric, threading.Lock())
+
+    def evict(self, metric):
+        self._models.pop(metric, None)
+
+    def __len__(self):
+        return len(self._models)
+
+
+class ForecastService:
+    r"""
+    asyncio HTTP server answering forecast and refit requests.
+
+    modelKwargs are passed to every DecomposedArima built by a refit.
+    Forecasts longer than maxHorizon days are refused.
+    """
+
+    def __init__(self,
+                 modelPath='./models',
+                 dataPath='./data',
+                 host='127.0.0.1',
+                 port=8080,
+                 maxModels=32,
+                 numThreads=4,
+                 numWorkers=None,
+                 modelKwargs=None,
+                 maxHorizon=1095):
+        self.modelPath = modelPath
+        self.dataPath = dataPath
+        self.host = host
+        self.port = port
+        self.maxHorizon = maxHorizon
+        self.modelKwargs = modelKwargs or {}
+
+        self.threadPool = ThreadPoolExecutor(max_workers=numThreads)
+        self.processPool = ProcessPoolExecutor(
+            max_workers=numWorkers,
+            mp_context=mp.get_context('spawn'))
+        self.store = ModelStore(modelPath,
+                                maxModels=maxModels,
+                                executor=self.threadPool)
+
+        self.server = None
+        self.numRequests = 0
+
+    async def start(self):
+        r""" Start listening.  With port=0 the bound port is set on self. """
+
+        self.server = await asyncio.start_server(self._handle,
+                                                 self.host,
+                                                 self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info('Serving forecasts on %s:%d.' % (self.host, self.port))
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+        self.threadPool.shutdown()
+        self.processPool.shutdown()
+
+    async def serveForever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def forecast(self, metric, horizon=30, alpha=0.2):
+        r""" Forecast records for metric, horizon days past its data. """
+
+        modelOb = await self.store.get(metric)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.threadPool,
+                                          _forecastRecords,
+                                          modelOb,
+                                          horizon,
+                                          alpha,
+                                          self.store.lock(metric))
+
+    async def refit(self, metric):
+        r""" Refit metric from its csv and replace the stored model. """
+
+        os.makedirs(self.modelPath, exist_ok=True)
+
+        loop = asyncio.get_running_loop()
+        elapsed = await loop.run_in_executor(self.processPool,
+                                             _refitModel,
+                                             self.dataPath,
+                                             self.store.modelFilePath(metric),
+                                             metric,
+                                             self.modelKwargs)
+        self.store.evict(metric)
+
+        return {'metric': metric, 'seconds': elapsed}
+
+    async def _handle(self, reader, writer):
+        try:
+            status, body = await self._route(reader)
+        except Exception:
+            # Details go to the log only, they can hold server paths.
+            logger.exception('Request failed.')
+            status, body = 500, {'error': 'Internal server error.'}
+
+        payload = json.dumps(body, default=str).encode()
+        writer.write(('HTTP/1.1 %d %s\r\n'
+                      'Content-Type: application/json\r\n'
+                      'Content-Length: %d\r\n'
+                      'Connection: close\r\n\r\n'
+                      % (status, _REASONS[status], len(payload))).encode()
+                     + payload)
+
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _route(self, reader):
+        requestLine = (await reader.readline()).decode('latin-1').split()
+
+        # Skip the headers, no route reads them or a body.
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+
+        if len(requestLine) < 2:
+            return 400, {'error': 'Malformed request line.'}
+
+        self.numRequests += 1
+        method, target = requestLine[0], requestLine[1]
+        url = urlsplit(target)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+        if url.path == '/health':
+            return 200, {'residentModels': len(self.store),
+                         'requests': self.numRequests}
+
+        if url.path not in ('/forecast', '/refit'):
+            return 404, {'error': 'Unknown path %s.' % url.path}
+
+        if 'metric' not in query:
+            return 400, {'error': 'metric is required.'}
+        metric = query['metric']
+
+        if not isValidMetric(metric):
+            return 400, {'error': 'Invalid metric name.'}
+
+        if url.path == '/refit':
+            if method != 'POST':
+                return 405, {'error': 'Use POST to refit.'}
+            # Checked here, before a worker fails on it with a server path.
+            if not os.path.exists(os.path.join(self.dataPath,
+                                               '%s.csv' % metric)):
+                return 404, {'error': 'No data for %s.' % metric}
+            return 200, await self.refit(metric)
+
+        if method != 'GET':
+            return 405, {'error': 'Use GET to forecast.'}
+
+        try:
+            horizon = int(query.get('horizon', 30))
+            alpha = float(query.get('alpha', 0.2))
+        except ValueError:
+            return 400, {'error': 'horizon and alpha must be numbers.'}
+
+        if not 1 <= horizon <= self.maxHorizon or not 0 < alpha < 1:
+            return 400, {'error': 'Need 1 <= horizon <= %d and 0 < alpha < 1.'
+                                  % self.maxHorizon}
+
+        try:
+            records = await self.forecast(metric, horizon, alpha)
+        except KeyError:
+            return 404, {'error': 'No saved model for %s.' % metric}
+
+        return 200, {'metric': metric,
+                     'horizon': horizon,
+                     'alpha': alpha,
+                     'forecast': records}
+
+
+def _loadModel(path):
+    from decomp_arima import DecomposedArima
+
+    return DecomposedArima.load(path)
+
+
+def _forecastRecords(modelOb, horizon, alpha, lock):
+    r"""
+    Out of sample predictions of a stored model as a list of dicts.
+
+    Predicts from a shallow copy, so requests with different horizons never
+    share numDaysPred, holding lock while it reads the shared fit.
+    """
+
+    forecastModel = copy.copy(modelOb)
+    forecastModel.numDaysPred = horizon
+
+    with lock:
+        predDf = forecastModel.predict(alpha=alpha)
+
+    predDf = predDf.loc[modelOb.lastObservedDate:].iloc[1:]
+
+    predDf = predDf.drop([modelOb.metric, 'InSamplePredictions'], axis=1)
+    predDf.columns = ['prediction', 'lower', 'upper']
+    dateFormat = '%Y-%m-%d'
+    if modelOb.resolution != 'daily':
+        dateFormat = '%Y-%m-%dT%H:%M'
+    predDf.index = pd.Index(predDf.index.strftime(dateFormat), name='date')
+
+    return predDf.reset_index().to_dict(orient='records')
+
+
+def _refitModel(dataPath, modelFilePath, metric, modelKwargs):
+    r""" Process pool worker: fit metric from its csv and save it. """
+
+    from decomp_arima import DecomposedArima
+
+    start = time.perf_counter()
+
+    modelOb = DecomposedArima(dataPath=dataPath, metric=metric, **modelKwargs)
+    modelOb.fit()
+
+    # Write next to the old model and swap, so loads never see half a file.
+    tmpPath = '%s.%d.tmp' % (modelFilePath, os.getpid())
+    modelOb.save(tmpPath)
+    os.replace(tmpPath, modelFilePath)
+
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--model-path', default='./models')
+    parser.add_argument('--data-path', default='./data')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-models', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-horizon', type=int, default=1095)
+    parser.add_argument('--arima-engine', default='pmdarima')
+    parser.add_argument('--resolution', default='daily',
+                        choices=['daily', 'hourly'])
+    args = parser.parse_args(argv)
+
+    configureLogging()
+
+    service = ForecastService(modelPath=args.model_path,
+                              dataPath=args.data_path,
+                              host=args.host,
+                              port=args.port,
+                              maxModels=args.max_models,
+                              numWorkers=args.workers,
+                              maxHorizon=args.max_horizon,
+                              modelKwargs={'arimaEngine': args.arima_engine,
+                                           'resolution': args.resolution})
+
+    try:
+        asyncio.run(service.serveForever())
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
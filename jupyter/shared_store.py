@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory, resource_tracker
+
+from ingest import loadDailySeries
+from instrumentation import getLogger
+
+logger = getLogger(__name__)
+
+
+r"""
+This module holds the daily series of a whole metric fleet in one shared
+memory block, so pool workers can read them without any I/O or pickling.
+
+The parent loads every metric once:
+
+    store = SharedDatasetStore.create('./data', metrics)
+
+and passes store.handle() (a small picklable dict) to the workers, which
+attach and read zero-copy views by metric name:
+
+    store = SharedDatasetStore.attach(handle)
+    modelOb = DecomposedArima(metric=metric, dailyData=store.dailyData(metric))
+
+The parent calls store.unlink() once every worker is done.
+"""
+
+
+class SharedDatasetStore:
+    r"""
+    Daily series of many metrics, back to back in one shared float64 block.
+
+    Every metric's days run gapless from its first to last observed date,
+    missing days are NaN.  Use create or attach, not the constructor.
+    """
+
+    def __init__(self, shm, layout, owner):
+        self.shm = shm
+        # metric -> (offset, length, startDate, meanVal)
+        self.layout = layout
+        self.owner = owner
+
+        numValues = sum(length for _, length, _, _ in layout.values())
+        self.block = np.ndarray((numValues,), dtype=np.float64, buffer=shm.buf)
+
+    @classmethod
+    def create(cls, dataPath, metrics, cachePath=None, chunkSize=None):
+        r""" Load metrics from dataPath into a new shared memory block. """
+
+        layout = {}
+        chunks = []
+        offset = 0
+        for metric in metrics:
+            dailyDf, meanVal = loadDailySeries(dataPath,
+                                               metric,
+                                               cachePath=cachePath,
+                                               chunkSize=chunkSize)
+
+            start = dailyDf.index.min()
+            numDays = (dailyDf.index.max() - start).days + 1
+
+            vals = np.full(numDays, np.nan)
+            vals[(dailyDf.index - start).days.values] = dailyDf[metric].values
+
+            layout[metric] = (offset, numDays, start, float(meanVal))
+            chunks.append(vals)
+            offset += numDays
+
+        # SharedMemory can't be empty.
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=max(8*offset, 8))
+
+        store = cls(shm, layout, owner=True)
+        if chunks:
+            store.block[:] = np.concatenate(chunks)
+        store.block.flags.writeable = False
+
+        logger.info('Shared %d metrics, %.1f MB.'
+                    % (len(layout), shm.size / 2**20))
+
+        return store
+
+    @classmethod
+    def attach(cls, handle):
+        r""" Attach to the block described by handle, in any process. """
+
+        shm = _attachSharedMemory(handle['name'])
+        store = cls(shm, handle['layout'], owner=False)
+        store.block.flags.writeable = False
+
+        return store
+
+    def handle(self):
+        r""" Picklable description of the block, for attach. """
+
+        return {'name': self.shm.name, 'layout': self.layout}
+
+    def __contains__(self, metric):
+        return metric in self.layout
+
+    def view(self, metric):
+        r""" Read-only zero-copy view of metric's daily values. """
+
+        offset, length, _, _ = self.layout[metric]
+
+        return self.block[offset:offset + length]
+
+    def series(self, metric):
+        r""" metric's daily values as a Series with a Date index. """
+
+        _, length, start, _ = self.layout[metric]
+
+        return pd.Series(self.view(metric),
+                         index=pd.Index(pd.date_range(start, periods=length),
+                                        name='Date'),
+                         name=metric,
+                         copy=False)
+
+    def dailyData(self, metric):
+        r"""
+        (dailyDf, meanVal) for metric, as loadDailySeries returns and the
+        dailyData argument of BaseConfig takes.
+        """
+
+        return self.series(metric).to_frame(), self.layout[metric][3]
+
+    def close(self):
+        r""" Detach this process.  Views are invalid afterwards. """
+
+        self.block = None
+        self.shm.close()
+
+    def unlink(self):
+        r""" Close and free the block.  Only the creating process should. """
+
+        self.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.unlink()
+
+
+def _attachSharedMemory(name):
+    r"""
+    Attach to an existing block without registering it with this process's
+    resource tracker, which would otherwise free it when the process exits.
+    """
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13
+        pass
+
+    # Unregistering after the fact is not enough: spawned workers share the
+    # parent's tracker, and would drop the parent's own registration.
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
@@ -0,0 +1,104 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+r"""
+This module writes synthetic <metric>.csv files in the Date, Time, metric
+layout BaseConfig reads, for benchmarks and for trying the pipeline out
+without real data.
+
+The daily signal is level + linear trend + yearly and weekly sinusoids, and
+every intraday sample adds an intraday sinusoid and independent noise on top.
+"""
+
+
+def makeSyntheticMetric(metric='SyntheticMetric',
+                        years=3,
+                        samplesPerDay=24,
+                        endDate='2020-06-30',
+                        level=1000.0,
+                        slopePerYear=200.0,
+                        yearlyAmplitude=0.1,
+                        weeklyAmplitude=0.05,
+                        intradayAmplitude=0.0,
+                        noise=0.02,
+                        gapFraction=0.0,
+                        seed=0):
+    r"""
+    Raw intraday frame with Date, Time and metric columns.
+
+    Amplitudes and noise are fractions of level.  gapFraction of the days are
+    dropped entirely, to exercise date imputation.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    end = pd.to_datetime(endDate)
+    dates = pd.date_range(end - pd.DateOffset(years=years)
+                          + pd.DateOffset(days=1), end)
+    t = np.arange(len(dates))
+
+    daily = (level
+             + slopePerYear * t / 365.25
+             + yearlyAmplitude * level * np.sin(2 * np.pi * t / 365.25)
+             + weeklyAmplitude * level * np.sin(2 * np.pi * t / 7))
+
+    if gapFraction > 0:
+        keep = rng.random(len(dates)) >= gapFraction
+        dates = dates[keep]
+        daily = daily[keep]
+
+    secondsPerSample = 86400 // samplesPerDay
+    times = pd.to_timedelta(np.arange(samplesPerDay) * secondsPerSample,
+                            unit='s')
+    timeStrs = ['%02d:%02d:%02d' % (s // 3600, s % 3600 // 60, s % 60)
+                for s in times.total_seconds().astype(int)]
+
+    intraday = intradayAmplitude * level * np.sin(
+        2 * np.pi * np.arange(samplesPerDay) / samplesPerDay)
+
+    values = (np.repeat(daily, samplesPerDay)
+              + np.tile(intraday, len(daily))
+              + noise * level * rng.standard_normal(len(daily) * samplesPerDay))
+
+    return pd.DataFrame({
+        'Date': np.repeat(dates.strftime('%Y-%m-%d'), samplesPerDay),
+        'Time': np.tile(timeStrs, len(daily)),
+        metric: values
+    })
+
+
+def writeSyntheticMetric(dataPath, metric='SyntheticMetric', **kwargs):
+    r"""
+    Write <dataPath>/<metric>.csv.  kwargs go to makeSyntheticMetric.
+
+    Returns the path written.
+    """
+
+    os.makedirs(dataPath, exist_ok=True)
+    path = '%s/%s.csv' % (dataPath, metric)
+    makeSyntheticMetric(metric=metric, **kwargs).to_csv(path, index=False)
+
+    return path
+
+
+def writeSyntheticFleet(dataPath, numMetrics, prefix='SyntheticMetric',
+                        **kwargs):
+    r"""
+    Write numMetrics metrics with different seeds and levels.
+
+    Returns the metric names.
+    """
+
+    metrics = ['%s%04d' % (prefix, i) for i in range(numMetrics)]
+
+    for i, metric in enumerate(metrics):
+        writeSyntheticMetric(dataPath,
+                             metric,
+                             seed=i,
+                             level=1000.0 * (1 + i % 10),
+                             **kwargs)
+
+    return metrics